@@ -7,12 +7,44 @@ import signal
 import configparser
 import datetime
 import base64
+import cProfile
+import functools
+import gc
+import gzip
+import hashlib
+import heapq
+import hmac
+import html
+import io
+import ipaddress
+import jmespath
+import math
+import marshal
+import mimetypes
+import pstats
+import re
+import socket
+import struct
+import traceback
+import tracemalloc
 import yaml
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+try:
+  import resource
+except ImportError:
+  resource = None
+
+from collections import Counter, OrderedDict
+from multiprocessing import Pipe
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 from jinja2.sandbox import SandboxedEnvironment as Environment
-from jinja2 import StrictUndefined
+from jinja2 import FileSystemBytecodeCache, FileSystemLoader, StrictUndefined, meta, nodes
+from jinja2.compiler import CodeGenerator
+from jinja2.defaults import DEFAULT_FILTERS
+from jinja2.visitor import NodeVisitor
+from ansible.errors import AnsibleFilterError
 from ansible.plugins.filter.core import FilterModule as CoreFilters
 from ansible.plugins.filter.mathstuff import FilterModule as MathFilters
 from ansible.plugins.filter.urls import FilterModule as UrlFilters
@@ -25,6 +57,7 @@ SCRIPT_BASE = os.path.splitext(os.path.basename(__file__))[0]
 HTML_FILE_PATH = os.path.join(CURRENT_DIR, SCRIPT_BASE + '.html')
 CONF_PATH = os.path.join(CURRENT_DIR, SCRIPT_BASE + '.conf')
 JSON_HISTORY_PATH = os.path.join(CURRENT_DIR, SCRIPT_BASE + '.json')
+STATIC_DIR = os.path.join(CURRENT_DIR, SCRIPT_BASE + '_static')
 
 # Load or create configuration
 config = configparser.ConfigParser()
@@ -34,18 +67,469 @@ if not os.path.exists(CONF_PATH):
     'directory': 'jinja2_eval_web_inputs',
     'refresh_interval': '1'
   }
+  config['server'] = {
+    'workers': '1',
+    'keep_alive_timeout': '15',
+    'max_keep_alive_requests': '100',
+    'websocket_idle_timeout': '300',
+    'websocket_max_message': '67108864'
+  }
+  config['render_cache'] = {
+    'max_entries': '256',
+    'max_bytes': '67108864'
+  }
+  config['input'] = {
+    'lazy_json': 'true',
+    'lazy_json_min_size': '1048576'
+  }
+  config['templates'] = {
+    'directory': 'jinja2_eval_web_templates',
+    'bytecode_cache': 'jinja2_eval_web_cache/bytecode'
+  }
+  config['input_cache'] = {
+    'enabled': 'true',
+    'directory': 'jinja2_eval_web_cache',
+    'max_bytes': '268435456'
+  }
+  config['filter_cache'] = {
+    'enabled': 'true',
+    'max_entries': '4096',
+    'max_bytes': '67108864',
+    'max_value_size': '65536'
+  }
+  config['render_budget'] = {
+    'max_operations': '10000000',
+    'max_seconds': '30',
+    'max_memory_mb': '1024',
+    'memory_tracking': 'rss'
+  }
+  config['output'] = {
+    'max_inline_size': '1048576',
+    'chunk_size': '262144',
+    'stored_results': '16'
+  }
+  config['diagnostics'] = {
+    'enabled': 'false',
+    'token': '',
+    'sample_interval_ms': '5',
+    'max_seconds': '300'
+  }
+  config['admission'] = {
+    'enabled': 'true',
+    'rate': '50',
+    'burst': '100',
+    'max_concurrent': '4',
+    'queue_size': '32',
+    'queue_timeout': '10'
+  }
   with open(CONF_PATH, 'w', encoding='utf-8') as conf_file:
     config.write(conf_file)
 else:
   config.read(CONF_PATH)
 
+# Settings read once at startup, as (type, default, minimum); a type may also
+# be a tuple of the allowed strings. POST /settings refuses values these
+# cannot parse, and bad values in the file fall back to the default, so the
+# restart that follows a settings change cannot fail on them.
+TYPED_SETTINGS = {
+  'history': {'max_entries': (int, 1000, 1)},
+  'server': {'workers': (int, 1, 0), 'keep_alive_timeout': (int, 15, 1), 'max_keep_alive_requests': (int, 100, 1),
+             'websocket_idle_timeout': (int, 300, 1), 'websocket_max_message': (int, 67108864, 1)},
+  'render_cache': {'max_entries': (int, 256, 0), 'max_bytes': (int, 67108864, 0)},
+  'input': {'lazy_json': (bool, True, None), 'lazy_json_min_size': (int, 1048576, 0)},
+  'input_cache': {'enabled': (bool, True, None), 'max_bytes': (int, 268435456, 0)},
+  'filter_cache': {'enabled': (bool, True, None), 'max_entries': (int, 4096, 0), 'max_bytes': (int, 67108864, 0),
+                   'max_value_size': (int, 65536, 0)},
+  'render_budget': {'max_operations': (int, 10000000, 0), 'max_seconds': (float, 30.0, 0),
+                    'max_memory_mb': (int, 1024, 0), 'memory_tracking': (('rss', 'tracemalloc', 'off'), 'rss', None)},
+  'output': {'max_inline_size': (int, 1048576, 1), 'chunk_size': (int, 262144, 1), 'stored_results': (int, 16, 1)},
+  'diagnostics': {'enabled': (bool, False, None), 'sample_interval_ms': (float, 5.0, 0.1),
+                  'max_seconds': (float, 300.0, 0)},
+}
+
+def parse_setting(section, key, text):
+  # Raises ValueError naming the key if text is not a valid value
+  kind, _, minimum = TYPED_SETTINGS[section][key]
+  if kind is bool:
+    if text.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+      raise ValueError(f'{key}: not a boolean: {text!r}')
+    return configparser.ConfigParser.BOOLEAN_STATES[text.lower()]
+  if isinstance(kind, tuple):
+    if text not in kind:
+      raise ValueError(f'{key}: not one of {", ".join(kind)}: {text!r}')
+    return text
+  try:
+    value = kind(text)
+  except ValueError:
+    raise ValueError(f'{key}: not {"an integer" if kind is int else "a number"}: {text!r}') from None
+  if not value >= minimum:
+    raise ValueError(f'{key}: must be at least {minimum}')
+  return value
+
+def setting(section, key):
+  text = config.get(section, key, fallback=None)
+  if text is None:
+    return TYPED_SETTINGS[section][key][1]
+  try:
+    return parse_setting(section, key, text)
+  except ValueError as e:
+    # A hand-edited file must not keep the server from starting
+    print(f'Invalid [{section}] setting ({e}), using the default')
+    return TYPED_SETTINGS[section][key][1]
+
 # Initial max entries
-MAX_ENTRIES = int(config.get('history', 'max_entries', fallback='1000'))
+MAX_ENTRIES = setting('history', 'max_entries')
+
+# Server processes; more than 1 starts the pre-fork mode, 0 means one per CPU
+SERVER_WORKERS = setting('server', 'workers')
+
+# Persistent connection limits (idle seconds / requests per connection)
+KEEP_ALIVE_TIMEOUT = setting('server', 'keep_alive_timeout')
+MAX_KEEP_ALIVE_REQUESTS = setting('server', 'max_keep_alive_requests')
+WEBSOCKET_IDLE_TIMEOUT = setting('server', 'websocket_idle_timeout')
+WEBSOCKET_MAX_MESSAGE = setting('server', 'websocket_max_message')
+
+# Render result cache bounds (entries / total output bytes)
+RENDER_CACHE_MAX_ENTRIES = setting('render_cache', 'max_entries')
+RENDER_CACHE_MAX_BYTES = setting('render_cache', 'max_bytes')
+
+# JSON inputs at least this long are decoded lazily, one container at a time
+LAZY_JSON = setting('input', 'lazy_json')
+LAZY_JSON_MIN_SIZE = setting('input', 'lazy_json_min_size')
+
+# Directory settings, relative to the script directory unless absolute
+DIRECTORY_DEFAULTS = {
+  ('templates', 'directory'): SCRIPT_BASE + '_templates',
+  ('templates', 'bytecode_cache'): SCRIPT_BASE + '_cache/bytecode',
+  ('input_cache', 'directory'): SCRIPT_BASE + '_cache',
+}
+
+def config_dir(cfg, section, key):
+  path = cfg.get(section, key, fallback=DIRECTORY_DEFAULTS[section, key])
+  return path if os.path.isabs(path) else os.path.join(CURRENT_DIR, path)
+
+def shared_directory_error(cfg):
+  # /templates/save writes into the template library and {% include %} reads
+  # from it; the caches hold files the server loads back (compiled bytecode,
+  # parsed inputs), so neither may lie inside the other
+  templates = os.path.realpath(config_dir(cfg, 'templates', 'directory'))
+  for section, key in (('templates', 'bytecode_cache'), ('input_cache', 'directory')):
+    cache = os.path.realpath(config_dir(cfg, section, key))
+    if os.path.commonpath([templates, cache]) in (templates, cache):
+      return f'[templates] directory and [{section}] {key} must not contain each other'
+  return None
+
+# Saved template library, and where its compiled bytecode is kept
+DIRECTORY_CONFIG = config
+_directory_error = shared_directory_error(config)
+if _directory_error:
+  print(f'Invalid directory settings ({_directory_error}), using the defaults')
+  DIRECTORY_CONFIG = configparser.ConfigParser()
+TEMPLATES_DIR = config_dir(DIRECTORY_CONFIG, 'templates', 'directory')
+TEMPLATES_BYTECODE_DIR = config_dir(DIRECTORY_CONFIG, 'templates', 'bytecode_cache')
+os.makedirs(TEMPLATES_BYTECODE_DIR, exist_ok=True)
+# Library names are relative paths of plain segments (no dot-files, no '..')
+TEMPLATE_NAME_RE = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9_.-]*(?:/[A-Za-z0-9_-][A-Za-z0-9_.-]*)*')
+
+# Parsed input files are kept here across restarts, up to max_bytes on disk
+INPUT_CACHE_ENABLED = setting('input_cache', 'enabled')
+INPUT_CACHE_DIR = config_dir(DIRECTORY_CONFIG, 'input_cache', 'directory')
+INPUT_CACHE_MAX_BYTES = setting('input_cache', 'max_bytes')
+# Part of every cache key; bump the leading number when parse_input changes
+INPUT_PARSER_VERSION = f'1/pyyaml-{yaml.__version__}'
+
+# Pure Ansible filters are memoized in one LRU (max_entries calls and about
+# max_bytes of arguments and results across all of them); calls with an
+# argument longer than max_value_size are not cached
+FILTER_CACHE_ENABLED = setting('filter_cache', 'enabled')
+FILTER_CACHE_MAX_ENTRIES = setting('filter_cache', 'max_entries')
+FILTER_CACHE_MAX_BYTES = setting('filter_cache', 'max_bytes')
+FILTER_CACHE_MAX_VALUE_SIZE = setting('filter_cache', 'max_value_size')
+
+# Work one render may do: sandboxed calls, attribute/item lookups and loop
+# passes, and wall-clock seconds (0 disables a limit)
+RENDER_MAX_OPERATIONS = setting('render_budget', 'max_operations')
+RENDER_MAX_SECONDS = setting('render_budget', 'max_seconds')
+RENDER_MAX_MEMORY = setting('render_budget', 'max_memory_mb') * 1024 * 1024
+# How render peak memory is measured: 'rss' samples the resident set size
+# (cheap, process-wide), 'tracemalloc' traces every Python allocation (exact,
+# but renders run several times slower), 'off' disables it
+RENDER_MEMORY_TRACKING = setting('render_budget', 'memory_tracking')
+if RENDER_MEMORY_TRACKING == 'tracemalloc':
+  tracemalloc.start()
+
+# Outputs longer than max_inline_size characters are answered with a preview
+# and a handle; the full text is kept for the last stored_results renders
+OUTPUT_MAX_INLINE = setting('output', 'max_inline_size')
+OUTPUT_CHUNK_SIZE = setting('output', 'chunk_size')
+OUTPUT_STORED_RESULTS = setting('output', 'stored_results')
+
+# On-demand profiling, allocation snapshots and thread dumps under /debug/.
+# Requests must carry the token in X-Diagnostics-Token; without a token only
+# loopback clients are served. A profiling session stops collecting after
+# max_seconds.
+DIAGNOSTICS_ENABLED = setting('diagnostics', 'enabled')
+DIAGNOSTICS_TOKEN = config.get('diagnostics', 'token', fallback='')
+DIAGNOSTICS_SAMPLE_INTERVAL = setting('diagnostics', 'sample_interval_ms') / 1000
+DIAGNOSTICS_MAX_SECONDS = setting('diagnostics', 'max_seconds')
+
+# Filters, tests and globals whose result changes between calls; templates
+# using any of them are never served from the render cache
+NONDETERMINISTIC_NAMES = {'random', 'shuffle', 'now', 'lipsum', 'password_hash', 'strftime', 'cycler', 'joiner'}
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_TEXT, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x8, 0x9, 0xA
+# Close codes (RFC 6455 7.4.1)
+WS_PROTOCOL_ERROR, WS_MESSAGE_TOO_BIG = 1002, 1009
+
+class WebSocketError(Exception):
+  def __init__(self, code, message):
+    super().__init__(message)
+    self.code = code
+
+# Serializes read-modify-write cycles on the history file across handler threads
+HISTORY_LOCK = threading.Lock()
+# Truncated results are shared through this directory in pre-fork mode
+SHARED_RESULTS_DIR = os.path.join(CURRENT_DIR, SCRIPT_BASE + '_cache', 'results')
+
+def load_static_assets(directory):
+  # Map '/static/...' URLs to (content type, body, gzip body or None, immutable)
+  # and return the plain -> content-hashed URL mapping used to rewrite the page
+  assets = {}
+  hashed_urls = {}
+  if not os.path.isdir(directory):
+    return assets, hashed_urls
+  for root, _, filenames in os.walk(directory):
+    for filename in filenames:
+      if filename.endswith('.gz') or filename.endswith('.md'):
+        continue
+      filepath = os.path.join(root, filename)
+      with open(filepath, 'rb') as asset_file:
+        body = asset_file.read()
+      if os.path.exists(filepath + '.gz'):
+        with open(filepath + '.gz', 'rb') as gz_file:
+          gz_body = gz_file.read()
+      else:
+        gz_body = gzip.compress(body, compresslevel=9, mtime=0)
+      if len(gz_body) >= len(body):
+        gz_body = None
+      content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+      if content_type.startswith('text/') or content_type == 'application/javascript':
+        content_type += '; charset=utf-8'
+      rel = os.path.relpath(filepath, directory).replace(os.sep, '/')
+      stem, ext = os.path.splitext(rel)
+      digest = hashlib.sha256(body).hexdigest()[:12]
+      url = '/static/' + rel
+      hashed_url = f'/static/{stem}.{digest}{ext}'
+      assets[url] = (content_type, body, gz_body, False)
+      assets[hashed_url] = (content_type, body, gz_body, True)
+      hashed_urls[url] = hashed_url
+  return assets, hashed_urls
+
+STATIC_ASSETS, STATIC_HASHED_URLS = load_static_assets(STATIC_DIR)
 
 with open(HTML_FILE_PATH, 'r', encoding='utf-8') as f:
   HTML_PAGE = f.read()
+for plain_url, hashed_url in STATIC_HASHED_URLS.items():
+  HTML_PAGE = HTML_PAGE.replace(f'"{plain_url}"', f'"{hashed_url}"')
+
+class RenderBudgetSlot(threading.local):
+  current = None
+
+_RENDER_BUDGET = RenderBudgetSlot()
+
+class RenderBudgetExceeded(Exception):
+  pass
+
+def peak_rss():
+  # ru_maxrss is in kilobytes, except on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+def memory_in_use():
+  # Bytes in use by the process, by the configured measure; None when unavailable
+  if RENDER_MEMORY_TRACKING == 'tracemalloc':
+    return tracemalloc.get_traced_memory()[0]
+  if RENDER_MEMORY_TRACKING != 'rss':
+    return None
+  try:
+    with open('/proc/self/statm', 'rb') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except OSError:
+    return peak_rss() if resource is not None else None
+
+# Renders in flight; a process-wide peak belongs to a render only if it ran alone
+ACTIVE_RENDERS = set()
+ACTIVE_RENDERS_LOCK = threading.Lock()
+RENDERS_ACTIVE = threading.Event()
+# Memory of running renders is sampled on this interval by a watchdog thread,
+# so a render making few but large allocations is still measured
+MEMORY_SAMPLE_INTERVAL = 0.01
+MEMORY_WATCHDOG = None
+
+def watch_render_memory():
+  while True:
+    RENDERS_ACTIVE.wait()
+    time.sleep(MEMORY_SAMPLE_INTERVAL)
+    with ACTIVE_RENDERS_LOCK:
+      budgets = [b for b in ACTIVE_RENDERS if b.memory_alone and b.memory_base is not None]
+      if budgets:
+        in_use = memory_in_use()
+        for budget in budgets:
+          budget.sample_memory(in_use)
+
+class RenderBudget:
+  # Charged from the sandbox hooks, so a runaway render stops at its next
+  # lookup, call or loop pass. Work done inside a single filter call is not
+  # interrupted.
+  def __init__(self, max_operations, max_seconds, max_memory=0):
+    self.max_operations = max_operations
+    self.max_seconds = max_seconds
+    self.max_memory = max_memory
+    self.operations = 0
+    self.start = time.monotonic()
+    self.deadline = self.start + max_seconds if max_seconds > 0 else None
+    self.memory_base = None
+    self.memory_peak = None
+    self.memory_alone = False
+    self.memory_exceeded = False
+
+  def charge(self):
+    self.operations += 1
+    if self.max_operations > 0 and self.operations > self.max_operations:
+      raise RenderBudgetExceeded(f'Render budget exceeded: more than {self.max_operations} operations')
+    if self.memory_exceeded:
+      raise RenderBudgetExceeded(f'Render memory limit exceeded: more than {self.max_memory // 1048576} MB')
+    # The clock is read every 256 operations
+    if not self.operations & 0xFF:
+      if self.deadline is not None and time.monotonic() > self.deadline:
+        raise RenderBudgetExceeded(f'Render budget exceeded: more than {self.max_seconds:g} seconds')
+
+  def sample_memory(self, in_use):
+    # Called by the watchdog while this render runs alone; the render stops
+    # at its next charge once over the limit
+    used = max(0, in_use - self.memory_base)
+    if used > self.memory_peak:
+      self.memory_peak = used
+    if self.max_memory > 0 and used > self.max_memory:
+      self.memory_exceeded = True
+
+  def iterate(self, iterable):
+    for item in iterable:
+      self.charge()
+      yield item
+
+  def start_memory(self):
+    global MEMORY_WATCHDOG
+    with ACTIVE_RENDERS_LOCK:
+      self.memory_alone = not ACTIVE_RENDERS
+      for other in ACTIVE_RENDERS:
+        other.memory_alone = False
+      ACTIVE_RENDERS.add(self)
+      if self.memory_alone and RENDER_MEMORY_TRACKING == 'tracemalloc':
+        tracemalloc.reset_peak()
+      self.memory_base = memory_in_use()
+      if self.memory_base is not None:
+        self.memory_peak = 0
+        if RENDER_MEMORY_TRACKING == 'rss' and resource is not None:
+          self.peak_rss_base = peak_rss()
+        # Started on first use, so each pre-fork worker runs its own
+        if MEMORY_WATCHDOG is None or not MEMORY_WATCHDOG.is_alive():
+          MEMORY_WATCHDOG = threading.Thread(target=watch_render_memory, daemon=True)
+          MEMORY_WATCHDOG.start()
+        RENDERS_ACTIVE.set()
+
+  def finish_memory(self):
+    with ACTIVE_RENDERS_LOCK:
+      ACTIVE_RENDERS.discard(self)
+      if not ACTIVE_RENDERS:
+        RENDERS_ACTIVE.clear()
+      if self.memory_base is None:
+        return
+      if not self.memory_alone:
+        # Other renders ran meanwhile and their memory cannot be told apart
+        # from this one's, so nothing is recorded or enforced
+        self.memory_peak = None
+        return
+      in_use = memory_in_use()
+      # Short spikes between samples (one big filter call) show up in the
+      # process-wide peak
+      peak = None
+      if RENDER_MEMORY_TRACKING == 'tracemalloc':
+        peak = tracemalloc.get_traced_memory()[1]
+      elif RENDER_MEMORY_TRACKING == 'rss' and resource is not None:
+        process_peak = peak_rss()
+        if process_peak > self.peak_rss_base:
+          peak = process_peak
+    self.memory_peak = max(self.memory_peak, in_use - self.memory_base, (peak or 0) - self.memory_base)
+
+  def run(self, render):
+    self.start_memory()
+    _RENDER_BUDGET.current = self
+    try:
+      output = render()
+    finally:
+      _RENDER_BUDGET.current = None
+      self.finish_memory()
+    if self.memory_peak is not None and self.max_memory > 0 and self.memory_peak > self.max_memory:
+      raise RenderBudgetExceeded(f'Render memory limit exceeded: more than {self.max_memory // 1048576} MB')
+    return output
+
+  def usage(self):
+    return {
+      'operations': self.operations,
+      'max_operations': self.max_operations,
+      'ms': round((time.monotonic() - self.start) * 1000, 1),
+      'max_ms': round(self.max_seconds * 1000)
+    }
 
-env = Environment(
+class BudgetCodeGenerator(CodeGenerator):
+  # Loop iterables go through environment.budget_iter, so loop passes are
+  # charged even when the body makes no call or lookup
+  def visit_For(self, node, frame):
+    iterable = nodes.Call(nodes.EnvironmentAttribute('budget_iter'), [node.iter], [], None, None, lineno=node.iter.lineno)
+    node = nodes.For(node.target, iterable, node.body, node.else_, node.test, node.recursive, lineno=node.lineno)
+    super().visit_For(node, frame)
+
+  def visit_Call(self, node, frame, forward_caller=False):
+    # The parser never produces EnvironmentAttribute; emit a plain call
+    # instead of a sandboxed one for the wrapper above
+    if isinstance(node.node, nodes.EnvironmentAttribute) and node.node.name == 'budget_iter':
+      self.write('environment.budget_iter(')
+      self.visit(node.args[0], frame)
+      self.write(')')
+      return
+    super().visit_Call(node, frame, forward_caller=forward_caller)
+
+class BudgetedEnvironment(Environment):
+  code_generator_class = BudgetCodeGenerator
+
+  def budget_iter(self, iterable):
+    budget = _RENDER_BUDGET.current
+    return iterable if budget is None else budget.iterate(iterable)
+
+  def call(self, context, obj, /, *args, **kwargs):
+    budget = _RENDER_BUDGET.current
+    if budget is not None:
+      budget.charge()
+    return Environment.call(self, context, obj, *args, **kwargs)
+
+  def getattr(self, obj, attribute):
+    budget = _RENDER_BUDGET.current
+    if budget is not None:
+      budget.charge()
+    return Environment.getattr(self, obj, attribute)
+
+  def getitem(self, obj, argument):
+    budget = _RENDER_BUDGET.current
+    if budget is not None:
+      budget.charge()
+    return Environment.getitem(self, obj, argument)
+
+env = BudgetedEnvironment(
+  loader=FileSystemLoader(TEMPLATES_DIR),
+  # The name changes with the code generator, so older bytecode is not loaded
+  bytecode_cache=FileSystemBytecodeCache(TEMPLATES_BYTECODE_DIR, '__jinja2_%s.budget.cache'),
   trim_blocks=True,
   lstrip_blocks=True,
   undefined=StrictUndefined
@@ -54,30 +538,1871 @@ env.filters.update(CoreFilters().filters())
 env.filters.update(MathFilters().filters())
 env.filters.update(UrlFilters().filters())
 
+def approx_size(value):
+  # Bytes held by value and the containers and strings inside it
+  size = sys.getsizeof(value)
+  if isinstance(value, dict):
+    size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+  elif isinstance(value, (list, tuple, set, frozenset)):
+    size += sum(approx_size(v) for v in value)
+  return size
+
+class FilterCache:
+  # LRU of memoized filter calls and compiled JMESPath expressions, keyed by
+  # (filter name, ...) and bounded in entries and in approximate bytes, since
+  # a single from_yaml result can be a whole parsed document
+  def __init__(self, max_entries, max_bytes):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.size = 0
+    self.counts = {}
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    # (True, value) for a cached call, (False, None) otherwise
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return False, None
+      self.entries.move_to_end(key)
+      return True, entry[0]
+
+  def put(self, key, value, size):
+    if self.max_entries <= 0 or size > self.max_bytes:
+      return
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+        self.counts[key[0]] -= 1
+      self.entries[key] = (value, size)
+      self.size += size
+      self.counts[key[0]] = self.counts.get(key[0], 0) + 1
+      while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+        (name, *_), (_, evicted) = self.entries.popitem(last=False)
+        self.size -= evicted
+        self.counts[name] -= 1
+
+FILTER_CACHE = FilterCache(FILTER_CACHE_MAX_ENTRIES if FILTER_CACHE_ENABLED else 0, FILTER_CACHE_MAX_BYTES)
+
+def compiled_jmespath(expr):
+  # Compiled expressions, shared by every json_query call
+  if not isinstance(expr, str):
+    return jmespath.compile(expr)
+  found, compiled = FILTER_CACHE.get(('json_query', expr))
+  if found:
+    compiled_jmespath.hits += 1
+    return compiled
+  compiled = jmespath.compile(expr)
+  compiled_jmespath.misses += 1
+  # A compiled expression takes about 100 bytes per character of its source
+  FILTER_CACHE.put(('json_query', expr), compiled, 100 * len(expr))
+  return compiled
+compiled_jmespath.hits = compiled_jmespath.misses = 0
+
+def json_query(data, expr):
+  # community.general's json_query, without the collection
+  try:
+    return compiled_jmespath(expr).search(data)
+  except jmespath.exceptions.JMESPathError as e:
+    raise AnsibleFilterError(f'JMESPathError in json_query filter plugin:\n{e}')
+  except Exception as e:
+    raise AnsibleFilterError(f'Error in jmespath.search in json_query filter plugin:\n{e}')
+
+env.filters['json_query'] = json_query
+
+# Filters whose result depends only on their arguments. Python's re module
+# already keeps compiled patterns, so the regex filters gain most from
+# memoizing whole calls (the same host name cleaned up on every loop pass).
+MEMOIZED_FILTERS = {
+  'regex_search', 'regex_replace', 'regex_findall', 'regex_escape', 'from_json', 'from_yaml',
+  'b64encode', 'b64decode', 'hash', 'checksum', 'md5', 'sha1', 'to_uuid', 'quote'
+}
+
+def copy_containers(value):
+  # Fresh dicts and lists around the shared (immutable) leaves
+  if isinstance(value, dict):
+    return {k: copy_containers(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [copy_containers(v) for v in value]
+  return value
+
+def memoized_filter(name, func):
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    # Argument types are part of the key, so 1, 1.0 and True differ
+    key = (name, args, tuple(kwargs.items()), tuple(type(v) for v in args + tuple(kwargs.values())))
+    try:
+      hash(key)
+    except TypeError:
+      # Lists, dicts and undefined values go straight to the filter
+      wrapper.uncached += 1
+      return func(*args, **kwargs)
+    if any(isinstance(arg, str) and len(arg) > FILTER_CACHE_MAX_VALUE_SIZE for arg in args):
+      wrapper.uncached += 1
+      return func(*args, **kwargs)
+    found, result = FILTER_CACHE.get(key)
+    if found:
+      wrapper.hits += 1
+    else:
+      result = func(*args, **kwargs)
+      wrapper.misses += 1
+      try:
+        FILTER_CACHE.put(key, result, approx_size(args) + approx_size(kwargs) + approx_size(result))
+      except RecursionError:
+        pass
+    # Callers get their own containers; templates may modify them
+    return copy_containers(result)
+  wrapper.hits = wrapper.misses = wrapper.uncached = 0
+  return wrapper
+
+if FILTER_CACHE_ENABLED:
+  env.filters.update({name: memoized_filter(name, env.filters[name]) for name in MEMOIZED_FILTERS})
+
+def filter_cache_stats():
+  filters = {}
+  for name in sorted(MEMOIZED_FILTERS):
+    func = env.filters[name]
+    if hasattr(func, 'uncached'):
+      filters[name] = {'hits': func.hits, 'misses': func.misses, 'entries': FILTER_CACHE.counts.get(name, 0),
+                       'uncached': func.uncached}
+  return {
+    'enabled': FILTER_CACHE_ENABLED,
+    'max_entries': FILTER_CACHE_MAX_ENTRIES,
+    'max_bytes': FILTER_CACHE_MAX_BYTES,
+    'bytes': FILTER_CACHE.size,
+    'filters': filters,
+    'jmespath': {'hits': compiled_jmespath.hits, 'misses': compiled_jmespath.misses,
+                 'entries': FILTER_CACHE.counts.get('json_query', 0)}
+  }
+
+class LazyJSONError(json.JSONDecodeError):
+  # Malformed JSON found while decoding a lazy container during a render
+  pass
+
+_json_whitespace = json.decoder.WHITESPACE.match
+_json_scanstring = json.decoder.scanstring
+_json_scan_once = json.decoder.JSONDecoder().scan_once
+# A run of anything but brackets, with strings consumed whole
+_json_skip_run = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*').match
+# Stands in for the contents of an unindexed object so C code that checks
+# the raw dict size (the json encoder's empty-dict fast path) does not see {}
+_LAZY_PENDING = object()
+
+def _json_skip_container(text, pos):
+  # End offset of the object/array starting at pos, without decoding it, plus
+  # the flat [start, end, ...] offsets of its direct child containers (or None)
+  # so indexing it later does not have to skip them a second time
+  depth = 0
+  spans = []
+  try:
+    while True:
+      ch = text[pos]
+      if ch == '[' or ch == '{':
+        depth += 1
+        if depth == 2:
+          spans.append(pos)
+        pos += 1
+      elif ch == ']' or ch == '}':
+        depth -= 1
+        pos += 1
+        if depth == 1:
+          spans.append(pos)
+        elif depth == 0:
+          return pos, spans or None
+      else:
+        # The run below consumes whole strings, so a quote it stopped at
+        # is never closed
+        raise LazyJSONError('Unterminated string starting at', text, pos)
+      pos = _json_skip_run(text, pos).end()
+  except IndexError:
+    raise LazyJSONError('Unterminated container', text, pos) from None
+
+def _json_lazy_value(text, pos, spans):
+  ch = text[pos:pos + 1]
+  if ch == '{' or ch == '[':
+    if spans is not None:
+      # Offsets recorded when the parent was skipped, in document order
+      next(spans)
+      end, child_spans = next(spans), None
+    else:
+      end, child_spans = _json_skip_container(text, pos)
+    proxy = LazyJSONDict if ch == '{' else LazyJSONList
+    return proxy(text, pos, child_spans), end
+  try:
+    return _json_scan_once(text, pos)
+  except StopIteration:
+    raise LazyJSONError('Expecting value', text, pos) from None
+
+def _json_index_container(text, pos, closing, spans=None):
+  # Decode one level of the container at pos: scalars are decoded, nested
+  # containers become unindexed lazy proxies. Returns (items, end offset).
+  items = []
+  if spans is not None:
+    spans = iter(spans)
+  try:
+    pos = _json_whitespace(text, pos + 1).end()
+    if text[pos:pos + 1] == closing:
+      return items, pos + 1
+    while True:
+      if closing == '}':
+        if text[pos:pos + 1] != '"':
+          raise LazyJSONError('Expecting property name enclosed in double quotes', text, pos)
+        key, pos = _json_scanstring(text, pos + 1)
+        pos = _json_whitespace(text, pos).end()
+        if text[pos:pos + 1] != ':':
+          raise LazyJSONError("Expecting ':' delimiter", text, pos)
+        pos = _json_whitespace(text, pos + 1).end()
+        value, pos = _json_lazy_value(text, pos, spans)
+        items.append((key, value))
+      else:
+        value, pos = _json_lazy_value(text, pos, spans)
+        items.append(value)
+      pos = _json_whitespace(text, pos).end()
+      ch = text[pos:pos + 1]
+      if ch == closing:
+        return items, pos + 1
+      if ch != ',':
+        raise LazyJSONError("Expecting ',' delimiter", text, pos)
+      pos = _json_whitespace(text, pos + 1).end()
+  except LazyJSONError:
+    raise
+  except json.JSONDecodeError as e:
+    raise LazyJSONError(e.msg, e.doc, e.pos) from None
+
+class LazyJSONDict(dict):
+  # A real dict whose contents are decoded from the raw JSON text on first
+  # use. Internal state lives in underscore slots, which the sandbox refuses
+  # to expose, so attribute lookups still fall through to the JSON keys.
+  __slots__ = ('_lazy_json_text', '_lazy_json_pos', '_lazy_json_spans')
+
+  def __init__(self, text, pos, spans=None):
+    dict.__init__(self)
+    dict.__setitem__(self, _LAZY_PENDING, None)
+    self._lazy_json_text = text
+    self._lazy_json_pos = pos
+    self._lazy_json_spans = spans
+
+  def _lazy_json_load(self):
+    # Returns the end offset of the object when this call indexed it
+    if self._lazy_json_pos is None:
+      return None
+    items, end = _json_index_container(self._lazy_json_text, self._lazy_json_pos, '}',
+                                       self._lazy_json_spans)
+    dict.clear(self)
+    dict.update(self, items)
+    self._lazy_json_pos = self._lazy_json_spans = None
+    return end
+
+class LazyJSONList(list):
+  # list counterpart of LazyJSONDict
+  __slots__ = ('_lazy_json_text', '_lazy_json_pos', '_lazy_json_spans')
+
+  def __init__(self, text, pos, spans=None):
+    list.__init__(self)
+    self._lazy_json_text = text
+    self._lazy_json_pos = pos
+    self._lazy_json_spans = spans
+
+  def _lazy_json_load(self):
+    if self._lazy_json_pos is None:
+      return None
+    items, end = _json_index_container(self._lazy_json_text, self._lazy_json_pos, ']',
+                                       self._lazy_json_spans)
+    list.extend(self, items)
+    self._lazy_json_pos = self._lazy_json_spans = None
+    return end
+
+  def __radd__(self, other):
+    # list + LazyJSONList concatenates the raw storage, empty until loaded
+    if not isinstance(other, list):
+      return NotImplemented
+    self._lazy_json_load()
+    return other + list(self)
+
+def _lazy_json_method(base, name):
+  method = getattr(base, name)
+  def wrapper(self, *args, **kwargs):
+    self._lazy_json_load()
+    for arg in args:
+      if isinstance(arg, (LazyJSONDict, LazyJSONList)):
+        arg._lazy_json_load()
+    return method(self, *args, **kwargs)
+  wrapper.__name__ = name
+  return wrapper
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__',
+              '__repr__', '__eq__', '__ne__', '__or__', '__ror__', '__ior__', '__reversed__',
+              '__sizeof__', 'get', 'keys', 'values', 'items', 'copy', 'pop', 'popitem',
+              'setdefault', 'update', 'clear'):
+  setattr(LazyJSONDict, _name, _lazy_json_method(dict, _name))
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__',
+              '__repr__', '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__add__',
+              '__iadd__', '__mul__', '__rmul__', '__imul__', '__reversed__', '__sizeof__',
+              'append', 'extend', 'insert', 'pop', 'remove', 'index', 'count', 'copy', 'sort',
+              'reverse', 'clear'):
+  setattr(LazyJSONList, _name, _lazy_json_method(list, _name))
+# Copies and pickles go through the wrapped methods instead of the raw storage
+LazyJSONDict.__reduce_ex__ = lambda self, protocol: (dict, (dict(self.items()),))
+LazyJSONList.__reduce_ex__ = lambda self, protocol: (list, (list(iter(self)),))
+
+def _yaml_representer_classes(cls):
+  yield cls
+  for sub in cls.__subclasses__():
+    yield from _yaml_representer_classes(sub)
+
+# YAML dumpers (Ansible's to_yaml included) dispatch on the exact type
+for _dumper in _yaml_representer_classes(yaml.representer.SafeRepresenter):
+  _dumper.add_representer(LazyJSONDict, _dumper.represent_dict)
+  _dumper.add_representer(LazyJSONList, _dumper.represent_list)
+
+def load_json_lazy(text):
+  # Root container with its top level indexed (which also checks the document
+  # is balanced), or None when the text is not a JSON object/array
+  pos = _json_whitespace(text, 0).end()
+  ch = text[pos:pos + 1]
+  if ch not in ('{', '['):
+    return None
+  root = LazyJSONDict(text, pos) if ch == '{' else LazyJSONList(text, pos)
+  try:
+    end = root._lazy_json_load()
+  except json.JSONDecodeError:
+    return None
+  if _json_whitespace(text, end).end() != len(text):
+    return None
+  return root
+
+def parse_input(text, paths=None, key=None):
+  # Large JSON documents are returned as lazy proxies (see LazyJSONDict)
+  if LAZY_JSON and len(text) >= LAZY_JSON_MIN_SIZE:
+    data = load_json_lazy(text)
+    if data is not None:
+      return data, 'JSON'
+  # Text identical to an input file (key is its content hash) is loaded from
+  # the on-disk cache instead of being parsed again
+  if key is not None and INPUT_FILE_CACHE is not None:
+    cached = INPUT_FILE_CACHE.load(key)
+    if cached is not None:
+      data, input_format = cached
+      if paths is not None:
+        data = project_data(data, paths)
+      return data, input_format
+  # Otherwise try to parse as JSON first, then YAML if JSON fails. With a set of
+  # referenced paths (see template_input_paths) only those subtrees are kept;
+  # for YAML the rest of the document is never constructed.
+  try:
+    data = json.loads(text)
+    input_format = 'JSON'
+    if paths is not None:
+      data = project_data(data, paths)
+  except json.JSONDecodeError:
+    data = yaml.safe_load(text) if paths is None else load_yaml_projected(text, paths)
+    input_format = 'YAML'
+  # If yaml.safe_load returns None for empty string, treat as empty dict
+  if data is None:
+    data = {}
+  return data, input_format
+
+def project_data(value, paths):
+  # Keep only the keys on the given paths; lists and scalars are kept whole
+  if () in paths or not isinstance(value, dict):
+    return value
+  projected = {}
+  for key in {path[0] for path in paths}:
+    if key in value:
+      projected[key] = project_data(value[key], {path[1:] for path in paths if path[0] == key})
+  return projected
+
+def load_yaml_projected(text, paths):
+  loader = yaml.SafeLoader(text)
+  try:
+    node = loader.get_single_node()
+    if node is None:
+      return None
+    return construct_yaml_projected(loader, node, paths)
+  finally:
+    loader.dispose()
+
+def construct_yaml_projected(loader, node, paths):
+  if () in paths or not isinstance(node, yaml.MappingNode) or node.tag != 'tag:yaml.org,2002:map':
+    return loader.construct_object(node, deep=True)
+  keys = {path[0] for path in paths}
+  projected = {}
+  for key_node, value_node in node.value:
+    # Merge keys pull in other mappings; build those documents in full
+    if key_node.tag == 'tag:yaml.org,2002:merge':
+      return loader.construct_object(node, deep=True)
+    key = loader.construct_object(key_node, deep=True)
+    try:
+      wanted = key in keys
+    except TypeError:
+      wanted = False
+    if wanted:
+      projected[key] = construct_yaml_projected(loader, value_node, {path[1:] for path in paths if path[0] == key})
+  return projected
+
+def input_error_message(error):
+  if isinstance(error, yaml.YAMLError):
+    return f'Input parsing error (tried JSON and YAML): {error}'
+  return f'Input parsing error: {error}'
+
+def render_output(template, data, input_format, profile=None, budget=None):
+  budget = budget or RenderBudget(RENDER_MAX_OPERATIONS, RENDER_MAX_SECONDS, RENDER_MAX_MEMORY)
+  if profile is None:
+    output = budget.run(lambda: template.render(data=data))
+  else:
+    output = budget.run(lambda: profile.run(template, data))
+  try:
+    parsed_out = json.loads(output)
+    output = json.dumps(parsed_out, indent=2, ensure_ascii=False)
+    headers = {'X-Result-Type': 'json', 'X-Input-Format': input_format}
+  except Exception:
+    headers = {'X-Result-Type': 'string', 'X-Input-Format': input_format}
+  if profile is not None:
+    headers['X-Render-Profile'] = json.dumps(profile.report(), separators=(',', ':'))
+  return output, headers
+
+def budget_header(budget):
+  headers = {'X-Render-Budget': json.dumps(budget.usage(), separators=(',', ':'))}
+  if budget.memory_peak is not None:
+    headers['X-Render-Peak-Memory'] = str(budget.memory_peak)
+  return headers
+
+# Entries kept in each section of a render profile
+PROFILE_TOP = 10
+_RENDER_PROFILE = threading.local()
+
+class RenderProfile:
+  # Timings for one render: seconds per template line, from the line events
+  # of the compiled template's frames (so a line includes the filters and
+  # calls it makes), and per call of the added filters (see profile_env)
+  def __init__(self, source):
+    self.source_lines = source.splitlines()
+    self.line_numbers = {}
+    self.lines = {}
+    self.filters = {}
+    self.slowest = []
+    self.calls = 0
+    self.line = None
+    self.mark = None
+    self.total = 0.0
+
+  def _trace_calls(self, frame, event, arg):
+    if '__jinja_template__' in frame.f_globals:
+      return self._trace_lines
+    return None
+
+  def _trace_lines(self, frame, event, arg):
+    now = time.perf_counter()
+    if self.line is not None:
+      self.lines[self.line][0] += now - self.mark
+    if event == 'line':
+      key = (frame.f_code, frame.f_lineno)
+      line = self.line_numbers.get(key)
+      if line is None:
+        template = frame.f_globals['__jinja_template__']
+        line = self.line_numbers[key] = (template.name, template.get_corresponding_lineno(frame.f_lineno))
+        self.lines.setdefault(line, [0.0, 0])
+      self.line = line
+    self.mark = now
+    return self._trace_lines
+
+  def record_filter(self, name, seconds):
+    entry = self.filters.setdefault(name, [0, 0.0, 0.0])
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds)
+    if self.line is not None:
+      self.lines[self.line][1] += 1
+    self.calls += 1
+    call = (seconds, self.calls, name, self.line)
+    if len(self.slowest) < PROFILE_TOP:
+      heapq.heappush(self.slowest, call)
+    elif seconds > self.slowest[0][0]:
+      heapq.heapreplace(self.slowest, call)
+
+  def run(self, template, data):
+    _RENDER_PROFILE.current = self
+    previous = sys.gettrace()
+    sys.settrace(self._trace_calls)
+    start = time.perf_counter()
+    try:
+      return template.render(data=data)
+    finally:
+      self.total = time.perf_counter() - start
+      sys.settrace(previous)
+      _RENDER_PROFILE.current = None
+
+  def _describe_line(self, line):
+    name, number = line
+    described = {'line': number}
+    if name is not None:
+      described['template'] = name
+    elif 0 < number <= len(self.source_lines):
+      described['source'] = self.source_lines[number - 1].strip()[:80]
+    return described
+
+  def report(self):
+    # Ranked by time; tracing overhead is included in every figure
+    lines = sorted(self.lines.items(), key=lambda item: item[1][0], reverse=True)
+    filters = sorted(self.filters.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+      'total_ms': round(self.total * 1000, 3),
+      'lines': [dict(self._describe_line(line), ms=round(seconds * 1000, 3), filter_calls=calls)
+                for line, (seconds, calls) in lines[:PROFILE_TOP]],
+      'filters': [{'name': name, 'calls': calls, 'ms': round(seconds * 1000, 3), 'max_ms': round(worst * 1000, 3)}
+                  for name, (calls, seconds, worst) in filters[:PROFILE_TOP]],
+      'slowest_calls': [dict({'filter': name, 'ms': round(seconds * 1000, 3)},
+                             **(self._describe_line(line) if line is not None else {}))
+                        for seconds, _, name, line in sorted(self.slowest, reverse=True)],
+    }
+
+def profiled_filter(name, func):
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    profile = getattr(_RENDER_PROFILE, 'current', None)
+    if profile is None:
+      return func(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      profile.record_filter(name, time.perf_counter() - start)
+  return wrapper
+
+# Profiled renders compile against this copy of the environment, whose
+# added filters (Ansible's, json_query) report to the active RenderProfile;
+# normal renders never go through the wrappers. The wrapped functions are the
+# ones normal renders call, memoized ones included.
+profile_env = env.overlay()
+profile_env.filters = {
+  name: profiled_filter(name, func) if func is not DEFAULT_FILTERS.get(name) else func
+  for name, func in env.filters.items()
+}
+
+def content_hash(text):
+  return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+# Tags that load saved templates; their source is not part of the analyzed
+# template and may change on disk
+LIBRARY_NODES = (nodes.Include, nodes.Import, nodes.FromImport, nodes.Extends)
+
+def template_is_deterministic(ast):
+  if any(True for _ in ast.find_all(LIBRARY_NODES)):
+    return False
+  for node in ast.find_all((nodes.Filter, nodes.Test, nodes.Name)):
+    if node.name in NONDETERMINISTIC_NAMES:
+      return False
+  return True
+
+# Methods the sandbox lets templates call on lists and dicts that change them
+# in place. They can be reached as attributes, subscripts or attr('...'), so
+# any string constant naming one counts.
+MUTATING_METHODS = {'append', 'extend', 'insert', 'pop', 'remove', 'sort', 'reverse', 'clear',
+                    'update', 'setdefault', 'popitem'}
+
+def template_may_mutate(ast):
+  # Saved templates are not part of the analyzed source and may do anything
+  if any(True for _ in ast.find_all(LIBRARY_NODES)):
+    return True
+  if any(node.attr in MUTATING_METHODS for node in ast.find_all(nodes.Getattr)):
+    return True
+  return any(isinstance(node.value, str) and node.value in MUTATING_METHODS for node in ast.find_all(nodes.Const))
+
+class InputPathVisitor(NodeVisitor):
+  # Collects the constant data.<attr> / data[<const>] chains of a template.
+  # A chain followed by a method call needs the object the method is called
+  # on; bare or rebound uses of `data` need the whole document.
+  def __init__(self):
+    self.paths = set()
+    self.dynamic = False
+
+  def chain_path(self, node):
+    keys = []
+    while True:
+      if isinstance(node, nodes.Getattr):
+        keys.append(node.attr)
+        node = node.node
+      elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+        keys.append(node.arg.value)
+        node = node.node
+      elif isinstance(node, nodes.Name) and node.name == 'data' and node.ctx == 'load':
+        return tuple(reversed(keys))
+      else:
+        return None
+
+  def visit_Getattr(self, node):
+    path = self.chain_path(node)
+    if path is None:
+      self.generic_visit(node)
+    else:
+      self.paths.add(path)
+
+  visit_Getitem = visit_Getattr
+
+  def visit_Call(self, node):
+    if isinstance(node.node, nodes.Getattr):
+      path = self.chain_path(node.node.node)
+      if path is not None:
+        self.paths.add(path)
+        for child in node.args + node.kwargs + [node.dyn_args, node.dyn_kwargs]:
+          if child is not None:
+            self.visit(child)
+        return
+    self.generic_visit(node)
+
+  def visit_Name(self, node):
+    if node.name == 'data':
+      if node.ctx == 'load':
+        self.paths.add(())
+      else:
+        self.dynamic = True
+
+def template_input_paths(ast):
+  # Paths under `data` the template can read, or None when it may read anything
+  for node in ast.find_all(LIBRARY_NODES):
+    # Included and extended templates (and imports "with context") see `data` too
+    if not isinstance(node, (nodes.Import, nodes.FromImport)) or node.with_context:
+      return None
+  if 'data' not in meta.find_undeclared_variables(ast):
+    return set()
+  visitor = InputPathVisitor()
+  visitor.visit(ast)
+  if visitor.dynamic or () in visitor.paths:
+    return None
+  # Drop paths already covered by a shorter one
+  return {path for path in visitor.paths if not any(path[:n] in visitor.paths for n in range(1, len(path)))}
+
+def paths_cover(have, need):
+  if have is None:
+    return True
+  if need is None:
+    return False
+  return all(any(path[:n] in have for n in range(len(path) + 1)) for path in need)
+
+def format_input_paths(paths):
+  if paths is None:
+    return 'data'
+  if not paths:
+    return '-'
+  formatted = []
+  for path in sorted(paths, key=repr):
+    text = 'data'
+    for key in path:
+      text += f'.{key}' if isinstance(key, str) and key.isidentifier() else f'[{key!r}]'
+    formatted.append(text)
+  # Header values must be latin-1; escape anything else
+  return ', '.join(formatted).encode('ascii', 'backslashreplace').decode('ascii')
+
+def analyze_template(expr):
+  # Parse once for the cache and projection checks; the AST is compiled later.
+  # Returns (ast or None on syntax error, deterministic, input paths)
+  try:
+    ast = env.parse(expr)
+  except Exception:
+    return None, False, None
+  return ast, template_is_deterministic(ast), template_input_paths(ast)
+
+class RenderCache:
+  # Bounded LRU of final render outputs and their result headers, keyed by
+  # (template hash, input hash)
+  def __init__(self, max_entries, max_bytes):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.size = 0
+    self.lock = threading.Lock()
+
+  def get(self, expr_key, input_key):
+    with self.lock:
+      entry = self.entries.get((expr_key, input_key))
+      if entry is not None:
+        self.entries.move_to_end((expr_key, input_key))
+      return entry
+
+  def put(self, expr_key, input_key, output, headers):
+    if self.max_entries <= 0 or len(output) > self.max_bytes:
+      return
+    with self.lock:
+      old = self.entries.pop((expr_key, input_key), None)
+      if old is not None:
+        self.size -= len(old[0])
+      self.entries[(expr_key, input_key)] = (output, headers)
+      self.size += len(output)
+      while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+        evicted, _ = self.entries.popitem(last=False)[1]
+        self.size -= len(evicted)
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES)
+
+class ResultStore:
+  # Full text of truncated outputs, addressed by content hash, oldest evicted
+  # first. In pre-fork mode they are files in a directory instead, since the
+  # chunk requests may reach another worker.
+  def __init__(self, max_entries, directory=None):
+    self.max_entries = max_entries
+    self.directory = directory
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def put(self, output):
+    result_id = content_hash(output)
+    if self.directory is not None:
+      result_path = os.path.join(self.directory, result_id + '.txt')
+      with open(f'{result_path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+        f.write(output)
+      os.replace(f'{result_path}.{os.getpid()}.tmp', result_path)
+      stored = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self.directory)
+                      if entry.name.endswith('.txt'))
+      for _, old_path in stored[:-self.max_entries or None]:
+        try:
+          os.remove(old_path)
+        except OSError:
+          pass
+      return result_id
+    with self.lock:
+      self.entries[result_id] = output
+      self.entries.move_to_end(result_id)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    return result_id
+
+  def get(self, result_id):
+    if self.directory is not None:
+      if not re.fullmatch(r'[0-9a-f]{32}', result_id):
+        return None
+      try:
+        with open(os.path.join(self.directory, result_id + '.txt'), 'r', encoding='utf-8') as f:
+          return f.read()
+      except OSError:
+        return None
+    with self.lock:
+      return self.entries.get(result_id)
+
+RESULT_STORE = ResultStore(OUTPUT_STORED_RESULTS)
+
+class AdmissionRejected(Exception):
+  def __init__(self, status, message, retry_after):
+    super().__init__(message)
+    self.status = status
+    self.retry_after = retry_after
+
+class AdmissionControl:
+  # Gate in front of renders that have to run (cache hits are not charged).
+  # Each client address has a token bucket refilled at 'rate' per second up
+  # to 'burst'; at most 'max_concurrent' renders run at once and up to
+  # 'queue_size' more wait for a slot, each for at most 'queue_timeout'
+  # seconds. A rate of 0 or a max_concurrent of 0 disables that limit.
+  # Limits are read from the [admission] section by configure().
+  MAX_CLIENTS = 4096
+
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.buckets = {}
+    self.active = 0
+    self.queued = 0
+    # Smoothed render duration, used to estimate Retry-After for 503s
+    self.render_seconds = 0.1
+    self.counters = {'admitted': 0, 'queued': 0, 'rate_limited': 0, 'queue_full': 0, 'queue_timeout': 0}
+    self.wait_total = 0.0
+    self.wait_max = 0.0
+    try:
+      self.configure()
+    except ValueError as e:
+      # A hand-edited file must not keep the server from starting
+      print(f'Invalid [admission] settings ({e}), using the defaults')
+      self.enabled, self.rate, self.burst, self.max_concurrent, self.queue_size, self.queue_timeout = \
+        self.parse_limits({})
+
+  @staticmethod
+  def parse_limits(values):
+    # values maps [admission] options to their strings; raises ValueError if
+    # any of them is invalid
+    enabled = values.get('enabled', 'true').lower()
+    if enabled not in configparser.ConfigParser.BOOLEAN_STATES:
+      raise ValueError(f'enabled: not a boolean: {enabled!r}')
+    return (
+      configparser.ConfigParser.BOOLEAN_STATES[enabled],
+      float(values.get('rate', '50')),
+      max(1.0, float(values.get('burst', '100'))),
+      int(values.get('max_concurrent', '4')),
+      int(values.get('queue_size', '32')),
+      float(values.get('queue_timeout', '10'))
+    )
+
+  def configure(self):
+    # Raises ValueError and keeps the current limits if any value is invalid
+    limits = self.parse_limits(config['admission'] if config.has_section('admission') else {})
+    with self.cond:
+      self.enabled, self.rate, self.burst, self.max_concurrent, self.queue_size, self.queue_timeout = limits
+      # Waiting renders may fit under the new limits
+      self.cond.notify_all()
+
+  def _take_token(self, client, now):
+    # Returns 0 when a token was taken, else the seconds until one is available
+    if self.rate <= 0:
+      return 0
+    tokens, last = self.buckets.pop(client, (self.burst, now))
+    tokens = min(self.burst, tokens + (now - last) * self.rate)
+    if len(self.buckets) >= self.MAX_CLIENTS:
+      # Buckets that have refilled completely carry no state worth keeping
+      self.buckets = {c: (t, l) for c, (t, l) in self.buckets.items() if t + (now - l) * self.rate < self.burst}
+    if tokens >= 1:
+      self.buckets[client] = (tokens - 1, now)
+      return 0
+    self.buckets[client] = (tokens, now)
+    return (1 - tokens) / self.rate
+
+  def _retry_after_busy(self):
+    return max(1, math.ceil(self.render_seconds * (self.queued + 1) / max(1, self.max_concurrent)))
+
+  def admit(self, client, rate_limited=True):
+    # Blocks until a render slot is free; use the result in a with statement
+    # so the slot is given back
+    with self.cond:
+      if not self.enabled:
+        self.active += 1
+        return AdmissionSlot(self, time.perf_counter())
+      now = time.monotonic()
+      wait = self._take_token(client, now) if rate_limited else 0
+      if wait:
+        self.counters['rate_limited'] += 1
+        raise AdmissionRejected(429, 'Too many render requests from this client', max(1, math.ceil(wait)))
+      if self.max_concurrent > 0 and self.active >= self.max_concurrent:
+        if self.queued >= self.queue_size:
+          self.counters['queue_full'] += 1
+          raise AdmissionRejected(503, 'Server busy - render queue is full', self._retry_after_busy())
+        self.queued += 1
+        self.counters['queued'] += 1
+        deadline = now + self.queue_timeout
+        try:
+          while self.enabled and self.max_concurrent > 0 and self.active >= self.max_concurrent:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+              self.counters['queue_timeout'] += 1
+              raise AdmissionRejected(503, 'Server busy - timed out waiting for a render slot', self._retry_after_busy())
+            self.cond.wait(remaining)
+        finally:
+          self.queued -= 1
+        waited = time.monotonic() - now
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+      self.active += 1
+      self.counters['admitted'] += 1
+      return AdmissionSlot(self, time.perf_counter())
+
+  def release(self, started):
+    with self.cond:
+      self.active -= 1
+      self.render_seconds = 0.8 * self.render_seconds + 0.2 * (time.perf_counter() - started)
+      self.cond.notify()
+
+  def stats(self):
+    with self.cond:
+      queued_total = self.counters['queued']
+      return {
+        'enabled': self.enabled,
+        'limits': {'rate': self.rate, 'burst': self.burst, 'max_concurrent': self.max_concurrent,
+                   'queue_size': self.queue_size, 'queue_timeout': self.queue_timeout},
+        'active': self.active,
+        'queued': self.queued,
+        'clients': len(self.buckets),
+        'admitted': self.counters['admitted'],
+        'queued_total': queued_total,
+        'rejected': {k: self.counters[k] for k in ('rate_limited', 'queue_full', 'queue_timeout')},
+        'avg_wait_ms': round(self.wait_total / queued_total * 1000, 2) if queued_total else 0,
+        'max_wait_ms': round(self.wait_max * 1000, 2),
+        'avg_render_ms': round(self.render_seconds * 1000, 2)
+      }
+
+class AdmissionSlot:
+  def __init__(self, control, started):
+    self.control = control
+    self.started = started
+
+  def release(self):
+    self.control.release(self.started)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
+
+ADMISSION = AdmissionControl()
+
+# From Python 3.12 cProfile is built on sys.monitoring: one profiler sees
+# every thread and a second one cannot be enabled while it runs. Before that
+# a profiler only sees the thread that enabled it.
+PROFILER_COVERS_ALL_THREADS = sys.version_info >= (3, 12)
+
+class ProfileSession:
+  # One profiling run over live traffic. 'cprofile' profiles each request
+  # from the moment its request line is parsed and merges the results (on
+  # 3.12+ a single profiler runs for the whole session instead, which also
+  # counts threads waiting for requests); 'sample' records the stack of
+  # every thread each sample interval, for collapsed-stack (flame graph)
+  # output.
+  def __init__(self, mode):
+    self.mode = mode
+    self.started = time.monotonic()
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.stats = pstats.Stats()
+    self.requests = 0
+    self.stacks = Counter()
+    self.samples = 0
+    self.profiler = None
+    if mode == 'cprofile' and PROFILER_COVERS_ALL_THREADS:
+      # Raises ValueError when another profiler is already active
+      profiler = cProfile.Profile()
+      profiler.enable()
+      self.profiler = profiler
+      self.timer = threading.Timer(DIAGNOSTICS_MAX_SECONDS, self._stop_profiler)
+      self.timer.daemon = True
+      self.timer.start()
+    if mode == 'sample':
+      self.thread = threading.Thread(target=self._sample, name='diagnostics-sampler', daemon=True)
+      self.thread.start()
+
+  def collecting(self):
+    return not self.stopped.is_set() and time.monotonic() - self.started < DIAGNOSTICS_MAX_SECONDS
+
+  def add_profile(self, profile):
+    with self.lock:
+      if not self.stopped.is_set():
+        self.stats.add(profile)
+        self.requests += 1
+
+  def count_request(self):
+    with self.lock:
+      self.requests += 1
+
+  def _stop_profiler(self):
+    with self.lock:
+      if self.profiler is not None:
+        self.profiler.disable()
+        self.stats.add(self.profiler)
+        self.profiler = None
+
+  def _sample(self):
+    own = threading.get_ident()
+    while not self.stopped.wait(DIAGNOSTICS_SAMPLE_INTERVAL) and self.collecting():
+      # Connection threads are numbered; drop the number so they merge
+      names = {t.ident: re.sub(r'-\d+', '', t.name) for t in threading.enumerate()}
+      for ident, frame in sys._current_frames().items():
+        if ident == own:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+          frame = frame.f_back
+        stack.append(names.get(ident, str(ident)))
+        self.stacks[';'.join(reversed(stack))] += 1
+      self.samples += 1
+
+  def stop(self):
+    with self.lock:
+      self.stopped.set()
+    if self.mode == 'sample':
+      self.thread.join()
+    elif PROFILER_COVERS_ALL_THREADS:
+      self.timer.cancel()
+      self._stop_profiler()
+
+  def status(self):
+    return {'mode': self.mode, 'seconds': round(time.monotonic() - self.started, 1),
+            'collecting': self.collecting(), 'requests': self.requests, 'samples': self.samples}
+
+  def report(self, output_format='text', sort='cumulative', limit=50):
+    # Returns (content type, body)
+    if self.mode == 'sample':
+      lines = [f'{stack} {count}' for stack, count in self.stacks.most_common()]
+      return 'text/plain', '\n'.join(lines) + '\n'
+    if output_format == 'raw':
+      # Loadable with pstats.Stats(<file>) or snakeviz
+      return 'application/octet-stream', marshal.dumps(self.stats.stats)
+    stream = io.StringIO()
+    self.stats.stream = stream
+    self.stats.sort_stats(sort).print_stats(limit)
+    return 'text/plain', f'{self.requests} requests profiled\n' + stream.getvalue()
+
+PROFILE_SESSION = None
+DIAGNOSTICS_LOCK = threading.Lock()
+
+TRACEMALLOC_SNAPSHOT = None
+
+def tracemalloc_top(limit, group='lineno', compare=False):
+  # Top allocation sites; with compare, growth since the previous snapshot
+  global TRACEMALLOC_SNAPSHOT
+  snapshot = tracemalloc.take_snapshot().filter_traces([
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+  ])
+  previous, TRACEMALLOC_SNAPSHOT = TRACEMALLOC_SNAPSHOT, snapshot
+  current, peak = tracemalloc.get_traced_memory()
+  result = {'traced': current, 'peak': peak, 'frames': tracemalloc.get_traceback_limit()}
+  if compare and previous is not None:
+    result['top'] = [{'trace': [str(f) for f in d.traceback], 'size': d.size, 'size_diff': d.size_diff,
+                      'count': d.count, 'count_diff': d.count_diff}
+                     for d in snapshot.compare_to(previous, group)[:limit]]
+  else:
+    result['top'] = [{'trace': [str(f) for f in st.traceback], 'size': st.size, 'count': st.count}
+                     for st in snapshot.statistics(group)[:limit]]
+  return result
+
+def thread_dump():
+  frames = sys._current_frames()
+  parts = []
+  for thread in threading.enumerate():
+    frame = frames.get(thread.ident)
+    parts.append(f'Thread {thread.name} (ident {thread.ident}{", daemon" if thread.daemon else ""}):\n')
+    if frame is not None:
+      parts.extend(traceback.format_stack(frame))
+    parts.append('\n')
+  return ''.join(parts)
+
+def saved_template_path(name):
+  # File of a library template, or None for names outside the library
+  if not name or not TEMPLATE_NAME_RE.fullmatch(name):
+    return None
+  return os.path.join(TEMPLATES_DIR, *name.split('/'))
+
+def list_saved_templates():
+  names = []
+  for root, dirs, files in os.walk(TEMPLATES_DIR):
+    dirs[:] = [d for d in dirs if not d.startswith('.')]
+    for filename in files:
+      if not filename.startswith('.'):
+        names.append(os.path.relpath(os.path.join(root, filename), TEMPLATES_DIR).replace(os.sep, '/'))
+  return sorted(names)
+
+def precompile_templates():
+  # Startup: load the library into the environment's template cache, through
+  # the bytecode cache, so the first include of a large macro file is cheap
+  for name in list_saved_templates():
+    try:
+      env.get_template(name)
+    except Exception:
+      continue
+
+def input_files_dir():
+  input_dir = config.get('input_files', 'directory', fallback='')
+  if input_dir and not os.path.isabs(input_dir):
+    input_dir = os.path.join(CURRENT_DIR, input_dir)
+  return input_dir
+
+class InputFileCache:
+  # Parsed input files marshalled to disk, one entry per (path, mtime, size,
+  # parser version), so restarts do not parse large YAML files again. Renders
+  # find an entry by the content hash of the submitted text, and get a fresh
+  # copy each time since sandboxed templates may mutate lists and dicts.
+  # Entries are signed with a key kept in the cache directory and only read
+  # back when the signature matches, since marshal trusts its input.
+  ENTRY_NAME_RE = re.compile(r'[0-9a-f]{32}\.entry')
+
+  def __init__(self, directory, max_bytes):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.by_content = {}
+    self.by_path = {}
+    self.hits = 0
+    self.stores = 0
+    self.warming = False
+    self.lock = threading.Lock()
+    self.key = None
+
+  def _entry_name(self, path, stat):
+    key = f'{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{INPUT_PARSER_VERSION}'
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest() + '.entry'
+
+  def _signing_key(self):
+    with self.lock:
+      if self.key is None:
+        os.makedirs(self.directory, exist_ok=True)
+        key_path = os.path.join(self.directory, 'key')
+        try:
+          fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+          with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+        except FileExistsError:
+          pass
+        with open(key_path, 'rb') as f:
+          key = f.read()
+        if len(key) != 32:
+          raise ValueError('Invalid input cache key')
+        self.key = key
+      return self.key
+
+  def _read_entry(self, name, with_data=True):
+    # (header, data), or (header, None) without with_data
+    with open(os.path.join(self.directory, name), 'rb') as f:
+      blob = f.read()
+    digest = hmac.new(self._signing_key(), blob[32:], 'sha256').digest()
+    if not hmac.compare_digest(blob[:32], digest):
+      raise ValueError('Bad input cache entry signature')
+    body = io.BytesIO(blob[32:])
+    header = marshal.load(body)
+    return header, marshal.load(body) if with_data else None
+
+  def _forget(self, name):
+    with self.lock:
+      for index in (self.by_content, self.by_path):
+        for key in [k for k, v in index.items() if v == name]:
+          del index[key]
+    try:
+      os.remove(os.path.join(self.directory, name))
+    except OSError:
+      pass
+
+  def load(self, content_key):
+    with self.lock:
+      name = self.by_content.get(content_key)
+    if name is None:
+      return None
+    entry_path = os.path.join(self.directory, name)
+    try:
+      header, data = self._read_entry(name)
+      # Loads refresh the mtime, which orders eviction
+      os.utime(entry_path)
+    except Exception:
+      self._forget(name)
+      return None
+    with self.lock:
+      self.hits += 1
+    return data, header['format']
+
+  def refresh(self, path):
+    # Store path's parsed form unless a current entry already exists
+    path = os.path.realpath(path)
+    try:
+      stat = os.stat(path)
+      name = self._entry_name(path, stat)
+      with self.lock:
+        if self.by_path.get(path) == name:
+          return
+      with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+      data, input_format = parse_input(text)
+    except Exception:
+      return
+    if isinstance(data, (LazyJSONDict, LazyJSONList)):
+      # Served lazily, which beats loading the whole document from disk
+      return
+    header = {'path': path, 'content': content_hash(text), 'format': input_format}
+    entry_path = os.path.join(self.directory, name)
+    try:
+      # Fails for values marshal cannot hold (YAML timestamps); those files
+      # are parsed on every render
+      body = marshal.dumps(header) + marshal.dumps(data)
+      digest = hmac.new(self._signing_key(), body, 'sha256').digest()
+      with open(entry_path + '.tmp', 'wb') as f:
+        f.write(digest + body)
+      os.replace(entry_path + '.tmp', entry_path)
+    except Exception:
+      return
+    with self.lock:
+      previous = self.by_path.get(path)
+    if previous is not None:
+      self._forget(previous)
+    with self.lock:
+      self.by_path[path] = name
+      self.by_content[header['content']] = name
+      self.stores += 1
+    self.enforce_limit()
+
+  def enforce_limit(self):
+    # Drop the least recently loaded entries until the directory fits max_bytes
+    entries = []
+    for name in os.listdir(self.directory):
+      if self.ENTRY_NAME_RE.fullmatch(name):
+        try:
+          stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      self._forget(name)
+      total -= size
+
+  def prewarm(self, input_dir):
+    # Startup: index entries from earlier runs, dropping stale ones, then
+    # parse the input files that have no current entry
+    self.warming = True
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      for name in os.listdir(self.directory):
+        if not self.ENTRY_NAME_RE.fullmatch(name):
+          # Interrupted writes, and entries of the earlier pickle format,
+          # which are never loaded
+          if name.endswith(('.tmp', '.pickle')):
+            self._forget(name)
+          continue
+        try:
+          header = self._read_entry(name, with_data=False)[0]
+          current = self._entry_name(header['path'], os.stat(header['path'])) == name
+        except Exception:
+          current = False
+        if not current:
+          self._forget(name)
+          continue
+        with self.lock:
+          self.by_path[header['path']] = name
+          self.by_content[header['content']] = name
+      if input_dir and os.path.isdir(input_dir):
+        for filename in sorted(os.listdir(input_dir)):
+          filepath = os.path.join(input_dir, filename)
+          if os.path.isfile(filepath):
+            self.refresh(filepath)
+      self.enforce_limit()
+    except OSError:
+      pass
+    finally:
+      self.warming = False
+
+  def stats(self):
+    with self.lock:
+      entries = len(self.by_path)
+      names = list(self.by_path.values())
+      stats = {'entries': entries, 'hits': self.hits, 'stores': self.stores, 'warming': self.warming,
+               'max_bytes': self.max_bytes}
+    size = 0
+    for name in names:
+      try:
+        size += os.path.getsize(os.path.join(self.directory, name))
+      except OSError:
+        pass
+    stats['bytes'] = size
+    return stats
+
+INPUT_FILE_CACHE = InputFileCache(INPUT_CACHE_DIR, INPUT_CACHE_MAX_BYTES) if INPUT_CACHE_ENABLED else None
+
+def limit_output(output, headers):
+  # Large outputs are cut to a preview; the rest is fetched from /result
+  if len(output) <= OUTPUT_MAX_INLINE:
+    return output, headers
+  preview = output[:OUTPUT_MAX_INLINE]
+  headers = dict(headers, **{
+    'X-Result-Truncated': 'true',
+    'X-Result-Id': RESULT_STORE.put(output),
+    'X-Result-Size': str(len(output)),
+    'X-Result-Next': str(len(preview))
+  })
+  return preview, headers
+
+def read_history():
+  try:
+    with open(JSON_HISTORY_PATH, 'r', encoding='utf-8') as hf:
+      return json.load(hf)
+  except Exception:
+    return []
+
+def history_memory_stats():
+  # Peak memory per distinct expression over the renders that measured it,
+  # heaviest first
+  by_expr = {}
+  for entry in read_history():
+    if 'peak_memory' not in entry:
+      continue
+    stats = by_expr.setdefault(entry.get('expr', ''), {'renders': 0, 'total': 0, 'max': 0, 'last': None})
+    stats['renders'] += 1
+    stats['total'] += entry['peak_memory']
+    stats['max'] = max(stats['max'], entry['peak_memory'])
+    stats['last'] = entry.get('datetime')
+  result = []
+  for expr, stats in by_expr.items():
+    try:
+      expr = base64.b64decode(expr).decode('utf-8')
+    except Exception:
+      pass
+    result.append({
+      'expr': expr,
+      'renders': stats['renders'],
+      'max_peak_memory': stats['max'],
+      'avg_peak_memory': stats['total'] // stats['renders'],
+      'last_render': stats['last']
+    })
+  result.sort(key=lambda item: item['max_peak_memory'], reverse=True)
+  return result
+
+def write_history(hist):
+  # Replaced atomically so readers never see a partly written file
+  with open(JSON_HISTORY_PATH + '.tmp', 'w', encoding='utf-8') as hf:
+    json.dump(hist, hf, indent=2)
+  os.replace(JSON_HISTORY_PATH + '.tmp', JSON_HISTORY_PATH)
+
+def append_history(entry):
+  with HISTORY_LOCK:
+    hist = read_history()
+    hist.append(entry)
+    write_history(hist[-MAX_ENTRIES:])
+
+def clear_history(count):
+  with HISTORY_LOCK:
+    hist = read_history()
+    original = len(hist)
+    if count is None:
+      hist = []
+      cleared = original
+    else:
+      try:
+        n = int(count)
+        cleared = min(n, original)
+        hist = hist[cleared:]
+      except Exception:
+        hist = []
+        cleared = original
+    write_history(hist)
+  return {'cleared': cleared, 'size': len(hist)}
+
+def update_config(section, values):
+  global MAX_ENTRIES
+  if not config.has_section(section):
+    config[section] = {}
+  for k, v in values.items():
+    config[section][k] = v
+  # update max entries if history section changed
+  if section == 'history' and 'max_entries' in config['history']:
+    try:
+      MAX_ENTRIES = int(config.get('history', 'max_entries'))
+    except Exception:
+      pass
+  return dict(config[section])
+
+def apply_settings(section, values):
+  saved = update_config(section, values)
+  if section == 'admission':
+    # POST /settings checks the values first (AdmissionControl.parse_limits)
+    ADMISSION.configure()
+  return saved
+
+def settings_section(section):
+  # A section as served by GET /settings; the diagnostics token is withheld
+  values = dict(config[section]) if config.has_section(section) else {}
+  if section == 'diagnostics' and values.get('token'):
+    values['token'] = '********'
+  return values
+
+def settings_error(section, values):
+  # Why values cannot be saved to section, or None. The merged section is
+  # checked before anything is applied or saved, since the file is read
+  # again when the server restarts after the change.
+  candidate = configparser.ConfigParser()
+  candidate.read_dict(config)
+  if not candidate.has_section(section):
+    candidate[section] = {}
+  candidate[section].update(values)
+  merged = dict(candidate[section])
+  try:
+    if section == 'admission':
+      AdmissionControl.parse_limits(merged)
+    for key, text in merged.items():
+      if key in TYPED_SETTINGS.get(section, {}):
+        parse_setting(section, key, text)
+  except ValueError as e:
+    return f'Invalid {section} setting: {e}'
+  if section in ('templates', 'input_cache'):
+    error = shared_directory_error(candidate)
+    if error:
+      return f'Invalid directory setting: {error}'
+  return None
+
+def save_settings(section, values):
+  # Only the configuration (and MAX_ENTRIES, which history writes trim to);
+  # the handler applies the rest. In pre-fork mode this runs in the
+  # supervisor, and a worker forked while it held a lock such as ADMISSION's
+  # would start with that lock held for good.
+  saved = update_config(section, values)
+  with open(CONF_PATH, 'w', encoding='utf-8') as cf:
+    config.write(cf)
+  return saved
+
+# Writes to the history and configuration files. In pre-fork mode a worker
+# sends them over WRITER_CONN to the supervisor, the only process that writes
+# those files, and waits for the result.
+FILE_WRITES = {'append_history': append_history, 'clear_history': clear_history, 'save_settings': save_settings}
+WRITER_CONN = None
+WRITER_LOCK = threading.Lock()
+
+def shared_write(op, *args):
+  if WRITER_CONN is None:
+    return FILE_WRITES[op](*args)
+  with WRITER_LOCK:
+    WRITER_CONN.send((op, args))
+    ok, result = WRITER_CONN.recv()
+  if not ok:
+    raise RuntimeError(result)
+  return result
+
+def serve_writes(conn):
+  # Supervisor side of one worker's pipe; ends when the worker goes away
+  while True:
+    try:
+      op, args = conn.recv()
+    except (EOFError, OSError):
+      conn.close()
+      return
+    try:
+      reply = (True, FILE_WRITES[op](*args))
+    except Exception as e:
+      reply = (False, str(e))
+    try:
+      conn.send(reply)
+    except OSError:
+      return
+
+def record_history(json_text, expr, peak_memory=None):
+  try:
+    ts = datetime.datetime.utcnow().isoformat() + 'Z'
+    entry = {
+      'datetime': ts,
+      'input': base64.b64encode(json_text.encode('utf-8')).decode('ascii'),
+      'expr': base64.b64encode(expr.encode('utf-8')).decode('ascii')
+    }
+    # Only renders that ran (not cache hits) have a measurement
+    if peak_memory is not None:
+      entry['peak_memory'] = peak_memory
+    shared_write('append_history', entry)
+  except Exception:
+    pass
+
+class RenderSession:
+  # State of one /ws/render connection. The parsed input and the compiled
+  # template are kept between messages, so an edit only reprocesses the
+  # side that changed.
+  def __init__(self):
+    self.json_text = None
+    self.input_key = None
+    self.data = None
+    self.data_paths = None
+    self.input_format = None
+    self.input_error = None
+    self.expr = None
+    self.expr_key = None
+    self.deterministic = False
+    self.paths = None
+    self.may_mutate = False
+    self.template = None
+    self.template_error = None
+    self.profile_template = None
+
+  def update(self, json_text=None, expr=None):
+    # The template goes first: its referenced paths decide how much of the
+    # input is kept
+    reparse = False
+    if expr is not None and expr != self.expr:
+      self.expr = expr
+      self.expr_key = content_hash(expr)
+      self.profile_template = None
+      ast, self.deterministic, self.paths = analyze_template(expr)
+      self.may_mutate = ast is None or template_may_mutate(ast)
+      try:
+        self.template = env.from_string(ast if ast is not None else expr)
+        self.template_error = None
+      except Exception as e:
+        self.template = None
+        self.template_error = f'Jinja expression error: {e}'
+      reparse = self.json_text is not None and not paths_cover(self.data_paths, self.paths)
+    if json_text is not None and json_text != self.json_text:
+      self.json_text = json_text
+      self.input_key = content_hash(json_text)
+      reparse = True
+    if reparse:
+      try:
+        self.data, self.input_format = parse_input(self.json_text, self.paths, self.input_key)
+        self.data_paths = self.paths
+        self.input_error = None
+      except Exception as e:
+        self.data, self.input_format = None, None
+        self.input_error = input_error_message(e)
+
+  def render(self, seq, profile=False):
+    # Returns the reply frame; 'headers' carries the same metadata as /render
+    if self.json_text is None:
+      self.update(json_text='')
+    if self.expr is None:
+      self.update(expr='')
+    if self.input_error:
+      return {'seq': seq, 'ok': False, 'error': self.input_error}
+    if self.template_error:
+      return {'seq': seq, 'ok': False, 'error': self.template_error}
+    cacheable = self.deterministic and not profile
+    cached = RENDER_CACHE.get(self.expr_key, self.input_key) if cacheable else None
+    peak_memory = None
+    if cached is not None:
+      output, headers = cached[0], dict(cached[1], **{'X-Render-Cache': 'hit'})
+    else:
+      # Live renders share the concurrency cap and queue, but not the
+      # per-client rate: a connection renders one message at a time
+      try:
+        slot = ADMISSION.admit(None, rate_limited=False)
+      except AdmissionRejected as e:
+        return {'seq': seq, 'ok': False, 'error': str(e), 'headers': {'Retry-After': str(e.retry_after)}}
+      budget = RenderBudget(RENDER_MAX_OPERATIONS, RENDER_MAX_SECONDS, RENDER_MAX_MEMORY)
+      try:
+        # A template that may modify its input gets a freshly parsed copy, so
+        # the kept data stays what the text says, as on /render
+        data = self.data
+        if self.may_mutate:
+          data = parse_input(self.json_text, self.paths, self.input_key)[0]
+        if profile:
+          if self.profile_template is None:
+            self.profile_template = profile_env.from_string(self.expr)
+          output, headers = render_output(self.profile_template, data, self.input_format,
+                                          RenderProfile(self.expr), budget)
+        else:
+          output, headers = render_output(self.template, data, self.input_format, budget=budget)
+      except LazyJSONError as e:
+        return {'seq': seq, 'ok': False, 'error': input_error_message(e)}
+      except RenderBudgetExceeded as e:
+        return {'seq': seq, 'ok': False, 'error': str(e), 'headers': budget_header(budget)}
+      except Exception as e:
+        return {'seq': seq, 'ok': False, 'error': f'Jinja expression error: {e}'}
+      finally:
+        slot.release()
+      headers['X-Input-Paths'] = format_input_paths(self.paths)
+      if cacheable:
+        RENDER_CACHE.put(self.expr_key, self.input_key, output, headers)
+      # Usage of this run only; cache hits cost nothing
+      headers = dict(headers, **budget_header(budget), **{'X-Render-Cache': 'miss' if cacheable else 'bypass'})
+      peak_memory = budget.memory_peak
+    record_history(self.json_text, self.expr, peak_memory)
+    output, headers = limit_output(output, headers)
+    return {'seq': seq, 'ok': True, 'output': output, 'headers': headers}
+
 class JinjaHandler(BaseHTTPRequestHandler):
-  def _send_headers(self, status=200, content_type='text/html', extra_headers=None):
+  protocol_version = 'HTTP/1.1'
+  # Idle connections are dropped after this many seconds without a request
+  timeout = KEEP_ALIVE_TIMEOUT
+  # Headers and body go out in separate writes; without TCP_NODELAY the
+  # second write waits on the client's delayed ACK on a reused connection
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    super().setup()
+    self.requests_served = 0
+
+  def parse_request(self):
+    # A cProfile session covers the request from here, not the wait for it
+    ok = super().parse_request()
+    session = PROFILE_SESSION
+    if ok and session is not None and session.mode == 'cprofile' and session.collecting():
+      if PROFILER_COVERS_ALL_THREADS:
+        session.count_request()
+        return ok
+      profile = cProfile.Profile()
+      try:
+        profile.enable()
+      except ValueError:
+        # Another profiler is active; a request never fails over profiling
+        return ok
+      self.profile = (session, profile)
+    return ok
+
+  def handle_one_request(self):
+    self.profile = None
+    try:
+      super().handle_one_request()
+    finally:
+      if self.profile is not None:
+        session, profile = self.profile
+        profile.disable()
+        session.add_profile(profile)
+
+  def _send_connection_headers(self):
+    self.requests_served += 1
+    if self.close_connection or self.requests_served >= MAX_KEEP_ALIVE_REQUESTS:
+      self.close_connection = True
+      self.send_header('Connection', 'close')
+    else:
+      self.send_header('Connection', 'keep-alive')
+      self.send_header('Keep-Alive', f'timeout={KEEP_ALIVE_TIMEOUT}, max={MAX_KEEP_ALIVE_REQUESTS - self.requests_served}')
+
+  def _send_headers(self, status=200, content_type='text/html', extra_headers=None, content_length=None):
     self.send_response(status)
     self.send_header('Content-type', content_type)
     self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
     self.send_header('Pragma', 'no-cache')
     self.send_header('Expires', '0')
+    if content_length is not None:
+      self.send_header('Content-Length', str(content_length))
     if extra_headers:
       for key, value in extra_headers.items():
         self.send_header(key, value)
+    self._send_connection_headers()
+    self.end_headers()
+
+  def _send(self, status=200, content_type='text/html', body=b'', extra_headers=None):
+    if isinstance(body, str):
+      body = body.encode('utf-8')
+    self._send_headers(status, content_type, extra_headers, content_length=len(body))
+    self.wfile.write(body)
+
+  def _send_static(self, path):
+    content_type, body, gz_body, immutable = STATIC_ASSETS[path]
+    self.send_response(200)
+    self.send_header('Content-type', content_type)
+    if immutable:
+      self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+    else:
+      self.send_header('Cache-Control', 'no-cache')
+    self.send_header('Vary', 'Accept-Encoding')
+    if gz_body is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+      body = gz_body
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self._send_connection_headers()
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _ws_read_exact(self, size):
+    data = self.rfile.read(size)
+    if len(data) < size:
+      raise ConnectionError('WebSocket closed by peer')
+    return data
+
+  def _ws_read_frame(self, limit):
+    first, second = self._ws_read_exact(2)
+    length = second & 0x7F
+    if length == 126:
+      length = struct.unpack('!H', self._ws_read_exact(2))[0]
+    elif length == 127:
+      length = struct.unpack('!Q', self._ws_read_exact(8))[0]
+    # Checked before reading, so a declared length is never allocated
+    if length > limit:
+      raise WebSocketError(WS_MESSAGE_TOO_BIG, 'Message too big')
+    # Clients must mask every frame (RFC 6455 5.1)
+    if not second & 0x80:
+      raise WebSocketError(WS_PROTOCOL_ERROR, 'Unmasked client frame')
+    mask = self._ws_read_exact(4)
+    payload = self._ws_read_exact(length)
+    if length:
+      # XOR the whole payload at once; a per-byte loop is too slow for large inputs
+      key = (mask * (length // 4 + 1))[:length]
+      payload = (int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+    return bool(first & 0x80), first & 0x0F, payload
+
+  def _ws_read_message(self):
+    fragments = []
+    size = 0
+    opcode = None
+    while True:
+      fin, frame_opcode, payload = self._ws_read_frame(WEBSOCKET_MAX_MESSAGE - size)
+      if frame_opcode == WS_PING:
+        self._ws_send(WS_PONG, payload)
+        continue
+      if frame_opcode == WS_PONG:
+        continue
+      if frame_opcode == WS_CLOSE:
+        return WS_CLOSE, payload
+      if frame_opcode:
+        opcode = frame_opcode
+      fragments.append(payload)
+      size += len(payload)
+      if fin:
+        return opcode, b''.join(fragments)
+
+  def _ws_send(self, opcode, payload):
+    length = len(payload)
+    if length < 126:
+      header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+      header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+      header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    self.wfile.write(header + payload)
+
+  def _handle_websocket(self):
+    key = self.headers.get('Sec-WebSocket-Key')
+    if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+      self.send_error(400, 'Expected WebSocket upgrade')
+      return
+    # Browsers let any page open a WebSocket to localhost, so only pages
+    # served from this host (or clients sending no Origin) may connect
+    origin = self.headers.get('Origin')
+    if origin is not None and urlparse(origin).netloc.lower() != self.headers.get('Host', '').lower():
+      self.send_error(403, 'Cross-origin WebSocket refused')
+      return
+    accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+    self.send_response(101, 'Switching Protocols')
+    self.send_header('Upgrade', 'websocket')
+    self.send_header('Connection', 'Upgrade')
+    self.send_header('Sec-WebSocket-Accept', accept)
     self.end_headers()
+    self.close_connection = True
+    self.connection.settimeout(WEBSOCKET_IDLE_TIMEOUT)
+
+    session = RenderSession()
+    while True:
+      try:
+        opcode, payload = self._ws_read_message()
+      except WebSocketError as e:
+        try:
+          self._ws_send(WS_CLOSE, struct.pack('!H', e.code) + str(e).encode('utf-8'))
+        except OSError:
+          pass
+        return
+      except (OSError, ValueError):
+        return
+      if opcode == WS_CLOSE:
+        try:
+          self._ws_send(WS_CLOSE, payload[:2])
+        except OSError:
+          pass
+        return
+      if opcode != WS_TEXT:
+        continue
+      try:
+        message = json.loads(payload.decode('utf-8'))
+        seq = message.get('seq')
+        session.update(message.get('json'), message.get('expr'))
+        reply = session.render(seq, bool(message.get('profile')))
+      except Exception as e:
+        reply = {'seq': None, 'ok': False, 'error': f'Invalid message: {e}'}
+      try:
+        self._ws_send(WS_TEXT, json.dumps(reply).encode('utf-8'))
+      except OSError:
+        return
+
+  def send_error(self, code, message=None, explain=None):
+    # Same page as BaseHTTPRequestHandler.send_error, but sized so the
+    # connection can stay open for the next request
+    try:
+      short, long = self.responses[code]
+    except KeyError:
+      short, long = '???', '???'
+    if message is None:
+      message = short
+    if explain is None:
+      explain = long
+    self.log_error('code %d, message %s', code, message)
+    body = b''
+    if code >= 200 and code not in (HTTPStatus.NO_CONTENT, HTTPStatus.RESET_CONTENT, HTTPStatus.NOT_MODIFIED):
+      body = (self.error_message_format % {
+        'code': code,
+        'message': html.escape(message, quote=False),
+        'explain': html.escape(explain, quote=False)
+      }).encode('UTF-8', 'replace')
+    self.send_response(code, message)
+    self.send_header('Content-Type', self.error_content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self._send_connection_headers()
+    self.end_headers()
+    if self.command != 'HEAD' and body:
+      self.wfile.write(body)
+
+  def _handle_diagnostics(self, path, params):
+    global PROFILE_SESSION
+    # Unknown unless enabled, refused without the token (or, when no token is
+    # configured, from anywhere but loopback)
+    if not DIAGNOSTICS_ENABLED:
+      self.send_error(404, 'File not found')
+      return
+    if DIAGNOSTICS_TOKEN:
+      allowed = hmac.compare_digest(self.headers.get('X-Diagnostics-Token', '').encode(), DIAGNOSTICS_TOKEN.encode())
+    else:
+      allowed = ipaddress.ip_address(self.client_address[0]).is_loopback
+    if not allowed:
+      self.send_error(403, 'Access denied - diagnostics token required')
+      return
+    param = lambda name, default: params.get(name, [default])[0]
+
+    if path == '/debug/threads':
+      self._send(200, 'text/plain', thread_dump())
+      return
+
+    if path == '/debug/profile':
+      session = PROFILE_SESSION
+      self._send(200, 'application/json', json.dumps(session.status() if session else {'mode': None}))
+      return
+
+    if path in ('/debug/profile/start', '/debug/profile/stop', '/debug/tracemalloc/start', '/debug/tracemalloc/stop') \
+        and self.command != 'POST':
+      self.send_error(405, 'Use POST')
+      return
+
+    if path == '/debug/profile/start':
+      mode = param('mode', 'cprofile')
+      if mode not in ('cprofile', 'sample'):
+        self.send_error(400, 'mode must be cprofile or sample')
+        return
+      with DIAGNOSTICS_LOCK:
+        if PROFILE_SESSION is not None:
+          self.send_error(409, f'A {PROFILE_SESSION.mode} session is already running')
+          return
+        try:
+          PROFILE_SESSION = ProfileSession(mode)
+        except ValueError as e:
+          self.send_error(409, f'Cannot start profiling: {e}')
+          return
+      self._send(200, 'application/json', json.dumps(dict(PROFILE_SESSION.status(), max_seconds=DIAGNOSTICS_MAX_SECONDS)))
+      return
+
+    if path == '/debug/profile/stop':
+      with DIAGNOSTICS_LOCK:
+        session, PROFILE_SESSION = PROFILE_SESSION, None
+      if session is None:
+        self.send_error(409, 'No profiling session is running')
+        return
+      session.stop()
+      try:
+        limit = int(param('limit', '50'))
+        content_type, body = session.report(param('format', 'text'), param('sort', 'cumulative'), limit)
+      except (KeyError, ValueError) as e:
+        self.send_error(400, f'Invalid report parameter: {e}')
+        return
+      headers = {'Content-Disposition': 'attachment; filename="profile.prof"'} if content_type != 'text/plain' else None
+      self._send(200, content_type, body, headers)
+      return
+
+    if path == '/debug/tracemalloc/start':
+      try:
+        frames = int(param('frames', '1'))
+        tracemalloc.start(frames)
+      except ValueError as e:
+        self.send_error(400, f'Invalid frames parameter: {e}')
+        return
+      self._send(200, 'application/json', json.dumps({'tracing': True, 'frames': tracemalloc.get_traceback_limit()}))
+      return
+
+    if path == '/debug/tracemalloc/stop':
+      if RENDER_MEMORY_TRACKING == 'tracemalloc':
+        self.send_error(409, 'tracemalloc is used for render memory tracking')
+        return
+      tracemalloc.stop()
+      self._send(200, 'application/json', json.dumps({'tracing': False}))
+      return
+
+    if path == '/debug/tracemalloc':
+      if not tracemalloc.is_tracing():
+        self.send_error(409, 'tracemalloc is not tracing - POST /debug/tracemalloc/start first')
+        return
+      try:
+        result = tracemalloc_top(int(param('limit', '20')), param('group', 'lineno'), param('compare', '') == '1')
+      except (KeyError, ValueError, TypeError) as e:
+        self.send_error(400, f'Invalid snapshot parameter: {e}')
+        return
+      self._send(200, 'application/json', json.dumps(result, indent=2))
+      return
+
+    self.send_error(404, 'File not found')
 
   def do_GET(self):
     parsed = urlparse(self.path)
     path = parsed.path
     params = parse_qs(parsed.query)
 
+    if path.startswith('/debug/'):
+      self._handle_diagnostics(path, params)
+      return
+
     if path == '/history':
-      self._send_headers(200, 'application/json')
-      try:
-        with open(JSON_HISTORY_PATH, 'r', encoding='utf-8') as hist_file:
-          raw_history = json.load(hist_file)
-      except Exception:
-        raw_history = []
+      raw_history = read_history()
       decoded = []
       for entry in raw_history:
         e = entry.copy()
@@ -90,40 +2415,90 @@ class JinjaHandler(BaseHTTPRequestHandler):
         except Exception:
           pass
         decoded.append(e)
-      self.wfile.write(json.dumps(decoded, indent=2).encode('utf-8'))
+      self._send(200, 'application/json', json.dumps(decoded, indent=2).encode('utf-8'))
+      return
+
+    if path == '/history/stats':
+      self._send(200, 'application/json', json.dumps(history_memory_stats(), indent=2).encode('utf-8'))
       return
 
     if path == '/history/size':
-      self._send_headers(200, 'application/json')
-      try:
-        with open(JSON_HISTORY_PATH, 'r', encoding='utf-8') as f:
-          hist = json.load(f)
-      except Exception:
-        hist = []
-      self.wfile.write(json.dumps({'size': len(hist)}).encode('utf-8'))
+      self._send(200, 'application/json', json.dumps({'size': len(read_history())}).encode('utf-8'))
       return
 
     if path == '/history/maxsize':
-      self._send_headers(200, 'application/json')
-      self.wfile.write(json.dumps({'max_size': MAX_ENTRIES}).encode('utf-8'))
+      self._send(200, 'application/json', json.dumps({'max_size': MAX_ENTRIES}).encode('utf-8'))
+      return
+
+    if path == '/templates':
+      self._send(200, 'application/json', json.dumps(list_saved_templates()).encode('utf-8'))
+      return
+
+    if path == '/template-content':
+      filepath = saved_template_path(params.get('name', [''])[0])
+      if filepath is None:
+        self.send_error(403, 'Access denied - invalid template name')
+        return
+      if not os.path.isfile(filepath):
+        self.send_error(404, 'Template not found')
+        return
+      with open(filepath, 'r', encoding='utf-8') as f:
+        self._send(200, 'text/plain', f.read().encode('utf-8'))
+      return
+
+    if path == '/admission':
+      self._send(200, 'application/json', json.dumps(ADMISSION.stats()).encode('utf-8'))
+      return
+
+    if path == '/filter-cache':
+      self._send(200, 'application/json', json.dumps(filter_cache_stats()).encode('utf-8'))
+      return
+
+    if path == '/input-cache':
+      stats = INPUT_FILE_CACHE.stats() if INPUT_FILE_CACHE is not None else {}
+      self._send(200, 'application/json', json.dumps(dict(stats, enabled=INPUT_FILE_CACHE is not None)).encode('utf-8'))
+      return
+
+    if path == '/result':
+      result_id = params.get('id', [None])[0]
+      if not result_id:
+        self.send_error(400, 'Missing id parameter')
+        return
+      output = RESULT_STORE.get(result_id)
+      if output is None:
+        self.send_error(404, 'Result expired')
+        return
+      if params.get('download', [None])[0]:
+        self._send(200, 'text/plain', output.encode('utf-8'), {
+          'Content-Disposition': 'attachment; filename="result.txt"'
+        })
+        return
+      try:
+        offset = max(0, int(params.get('offset', ['0'])[0]))
+      except ValueError:
+        self.send_error(400, 'Invalid offset parameter')
+        return
+      chunk = output[offset:offset + OUTPUT_CHUNK_SIZE]
+      self._send(200, 'text/plain', chunk.encode('utf-8'), {
+        'X-Result-Size': str(len(output)),
+        'X-Result-Next': str(offset + len(chunk))
+      })
       return
 
     if path == '/settings':
-      self._send_headers(200, 'application/json')
       section = params.get('section', [None])[0]
       if section:
-        data = dict(config[section]) if config.has_section(section) else {}
+        data = settings_section(section)
       else:
-        data = {s: dict(config[s]) for s in config.sections()}
-      self.wfile.write(json.dumps(data, indent=2).encode('utf-8'))
+        data = {s: settings_section(s) for s in config.sections()}
+      self._send(200, 'application/json', json.dumps(data, indent=2).encode('utf-8'))
       return
 
     if path == '/input-files':
-      self._send_headers(200, 'application/json')
       try:
         input_dir = config.get('input_files', 'directory', fallback='')
         if not input_dir:
-          self.wfile.write(json.dumps([]).encode('utf-8'))
+          self._send(200, 'application/json', json.dumps([]).encode('utf-8'))
           return
 
         # Convert relative path to absolute if needed
@@ -131,7 +2506,7 @@ class JinjaHandler(BaseHTTPRequestHandler):
           input_dir = os.path.join(CURRENT_DIR, input_dir)
 
         if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
-          self.wfile.write(json.dumps([]).encode('utf-8'))
+          self._send(200, 'application/json', json.dumps([]).encode('utf-8'))
           return
 
         files = []
@@ -141,9 +2516,9 @@ class JinjaHandler(BaseHTTPRequestHandler):
             files.append(filename)
 
         files.sort()
-        self.wfile.write(json.dumps(files).encode('utf-8'))
+        self._send(200, 'application/json', json.dumps(files).encode('utf-8'))
       except Exception:
-        self.wfile.write(json.dumps([]).encode('utf-8'))
+        self._send(200, 'application/json', json.dumps([]).encode('utf-8'))
       return
 
     if path == '/input-file-content':
@@ -189,155 +2564,284 @@ class JinjaHandler(BaseHTTPRequestHandler):
         with open(filepath, 'r', encoding='utf-8') as f:
           content = f.read()
 
-        self._send_headers(200, 'text/plain')
-        self.wfile.write(content.encode('utf-8'))
+        # The editor posts this text back to /render; make sure its parsed
+        # form is cached (a no-op when the entry is current)
+        if INPUT_FILE_CACHE is not None:
+          threading.Thread(target=INPUT_FILE_CACHE.refresh, args=(filepath,), daemon=True).start()
+
+        self._send(200, 'text/plain', content.encode('utf-8'))
         self.wfile.flush()
       except Exception as e:
         self.send_error(500, f'Error reading file: {e}')
       return
 
+    if path == '/ws/render':
+      self._handle_websocket()
+      return
+
+    if path.startswith('/static/'):
+      if path not in STATIC_ASSETS:
+        self.send_error(404, 'File not found')
+        return
+      self._send_static(path)
+      return
+
     if path != '/':
       self.send_error(404, 'File not found')
       return
 
-    self._send_headers()
-    self.wfile.write(HTML_PAGE.encode('utf-8'))
+    self._send(body=HTML_PAGE.encode('utf-8'))
 
   def do_POST(self):
-    global MAX_ENTRIES
     parsed = urlparse(self.path)
     path = parsed.path
     length = int(self.headers.get('Content-Length', 0))
     post_data = self.rfile.read(length)
     params = parse_qs(post_data.decode())
 
+    if path.startswith('/debug/'):
+      self._handle_diagnostics(path, dict(parse_qs(parsed.query), **params))
+      return
+
     if path == '/history/clear':
-      count = params.get('count', [None])[0]
-      try:
-        with open(JSON_HISTORY_PATH, 'r', encoding='utf-8') as f:
-          hist = json.load(f)
-      except Exception:
-        hist = []
-      original = len(hist)
-      if count is None:
-        hist = []
-        cleared = original
-      else:
-        try:
-          n = int(count)
-          cleared = min(n, original)
-          hist = hist[cleared:]
-        except Exception:
-          hist = []
-          cleared = original
-      with open(JSON_HISTORY_PATH, 'w', encoding='utf-8') as f:
-        json.dump(hist, f, indent=2)
-      self._send_headers(200, 'application/json')
-      self.wfile.write(json.dumps({'cleared': cleared, 'size': len(hist)}).encode('utf-8'))
+      result = shared_write('clear_history', params.get('count', [None])[0])
+      self._send(200, 'application/json', json.dumps(result).encode('utf-8'))
       return
 
     if path == '/settings':
       section = params.get('section', [None])[0]
       if not section:
-        self._send_headers(400, 'application/json')
-        self.wfile.write(json.dumps({'error': 'Missing section parameter'}).encode('utf-8'))
+        self._send(400, 'application/json', json.dumps({'error': 'Missing section parameter'}).encode('utf-8'))
         return
-      if not config.has_section(section):
-        config[section] = {}
-      for k, v in params.items():
-        if k == 'section':
-          continue
-        config[section][k] = v[0]
-      with open(CONF_PATH, 'w', encoding='utf-8') as cf:
-        config.write(cf)
-      # update max entries if history section changed
-      if section == 'history' and 'max_entries' in config['history']:
+      if section == 'diagnostics':
+        # Enabling diagnostics or changing the token needs access to the server
+        self.send_error(403, 'Diagnostics settings can only be changed in the configuration file')
+        return
+      values = {k: v[0] for k, v in params.items() if k != 'section'}
+      error = settings_error(section, values)
+      if error:
+        self._send(400, 'application/json', json.dumps({'error': error}).encode('utf-8'))
+        return
+      saved = shared_write('save_settings', section, values)
+      # In pre-fork mode the supervisor wrote the file; keep this worker's view in step
+      apply_settings(section, values)
+      self._send(200, 'application/json', json.dumps({section: saved}, indent=2).encode('utf-8'))
+      return
+
+    if path in ('/templates/save', '/templates/delete'):
+      name = params.get('name', [''])[0]
+      filepath = saved_template_path(name)
+      if filepath is None:
+        self.send_error(403, 'Access denied - invalid template name')
+        return
+      if path == '/templates/delete':
+        if not os.path.isfile(filepath):
+          self.send_error(404, 'Template not found')
+          return
+        os.remove(filepath)
+        # Drop the directories the delete left empty
+        parent = os.path.dirname(filepath)
+        while parent != TEMPLATES_DIR and not os.listdir(parent):
+          os.rmdir(parent)
+          parent = os.path.dirname(parent)
+        self._send(200, 'application/json', json.dumps({'deleted': name}).encode('utf-8'))
+        return
+      source = params.get('source', [''])[0]
+      try:
+        env.parse(source)
+      except Exception as e:
+        self._send(400, 'text/plain', f'Jinja expression error: {e}'.encode())
+        return
+      # Hidden from the listing, and unique so concurrent saves of one name
+      # do not write the same file
+      tmp_path = os.path.join(os.path.dirname(filepath),
+                              f'.{os.path.basename(filepath)}.{os.getpid()}.{threading.get_ident()}.tmp')
+      try:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+          f.write(source)
+        os.replace(tmp_path, filepath)
+      except OSError as e:
         try:
-          MAX_ENTRIES = int(config.get('history', 'max_entries'))
-        except Exception:
+          os.remove(tmp_path)
+        except OSError:
           pass
-      self._send_headers(200, 'application/json')
-      self.wfile.write(json.dumps({section: dict(config[section])}, indent=2).encode('utf-8'))
+        # The name is taken by a directory, or a part of its path by a file
+        if isinstance(e, (IsADirectoryError, NotADirectoryError, FileExistsError)):
+          self.send_error(409, f'Template name conflicts with an existing path: {name}')
+        else:
+          self.send_error(500, f'Error saving template: {e}')
+        return
+      # Compile now so the bytecode cache holds the new version
+      env.get_template(name)
+      self._send(200, 'application/json', json.dumps({'saved': name}).encode('utf-8'))
       return
 
     if path != '/render':
-      self._send_headers(404)
       self.send_error(404, 'Endpoint not found')
       return
 
     json_text = params.get('json', [''])[0]
     expr = params.get('expr', [''])[0]
+    # Render-by-name: the saved template is included, so it gets the same
+    # context, history entry and cache handling as an editor template
+    name = params.get('name', [''])[0]
+    if name:
+      filepath = saved_template_path(name)
+      if filepath is None or not os.path.isfile(filepath):
+        self.send_error(404, 'Template not found')
+        return
+      expr = f'{{% include "{name}" %}}'
+    # Profiled renders always run the template and are never cached
+    profile = params.get('profile', [''])[0].lower() in ('1', 'true', 'yes', 'on')
+
+    expr_key, input_key = content_hash(expr), content_hash(json_text)
+    ast, deterministic, paths = analyze_template(expr)
+    cacheable = deterministic and not profile
+    cached = RENDER_CACHE.get(expr_key, input_key) if cacheable else None
+    if cached is not None:
+      record_history(json_text, expr)
+      output, headers = limit_output(cached[0], dict(cached[1], **{'X-Render-Cache': 'hit'}))
+      self._send(200, 'text/plain', output.encode(), headers)
+      return
 
-    # Try to parse as JSON first, then YAML if JSON fails
     try:
-      data = json.loads(json_text)
-      input_format = 'JSON'
-    except json.JSONDecodeError:
+      slot = ADMISSION.admit(self.client_address[0])
+    except AdmissionRejected as e:
+      self._send(e.status, 'text/plain', str(e).encode(), {'Retry-After': str(e.retry_after)})
+      return
+
+    with slot:
+      try:
+        data, input_format = parse_input(json_text, paths, input_key)
+      except Exception as e:
+        self._send(400, 'text/plain', input_error_message(e).encode())
+        return
+
+      budget = RenderBudget(RENDER_MAX_OPERATIONS, RENDER_MAX_SECONDS, RENDER_MAX_MEMORY)
       try:
-        data = yaml.safe_load(json_text)
-        input_format = 'YAML'
-        # If yaml.safe_load returns None for empty string, treat as empty dict
-        if data is None:
-          data = {}
-      except yaml.YAMLError as e:
-        self._send_headers(400, 'text/plain')
-        self.wfile.write(f'Input parsing error (tried JSON and YAML): {e}'.encode())
+        if profile:
+          template = profile_env.from_string(expr)
+          output, headers = render_output(template, data, input_format, RenderProfile(expr), budget)
+        else:
+          template = env.from_string(ast if ast is not None else expr)
+          output, headers = render_output(template, data, input_format, budget=budget)
+      except LazyJSONError as e:
+        # Syntax errors inside a lazily indexed container surface on first access
+        self._send(400, 'text/plain', input_error_message(e).encode())
+        return
+      except RenderBudgetExceeded as e:
+        self._send(400, 'text/plain', str(e).encode(), budget_header(budget))
         return
       except Exception as e:
-        self._send_headers(400, 'text/plain')
-        self.wfile.write(f'Input parsing error: {e}'.encode())
+        self._send(400, 'text/plain', f'Jinja expression error: {e}'.encode())
         return
 
-    try:
-      template = env.from_string(expr)
-      output = template.render(data=data)
+    # The slot is given back before the response is written
+    headers['X-Input-Paths'] = format_input_paths(paths)
+    if cacheable:
+      RENDER_CACHE.put(expr_key, input_key, output, headers)
+    # Usage of this run only; cache hits cost nothing
+    headers = dict(headers, **budget_header(budget), **{'X-Render-Cache': 'miss' if cacheable else 'bypass'})
+    record_history(json_text, expr, budget.memory_peak)
+    output, headers = limit_output(output, headers)
+    self._send(200, 'text/plain', output.encode(), headers)
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+  # Every pre-fork worker binds its own socket to HOST:PORT and the kernel
+  # spreads incoming connections across them
+  def server_bind(self):
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    super().server_bind()
+
+def watch_files(paths, before_restart=None):
+  last_mtimes = {p: os.path.getmtime(p) for p in paths}
+  while True:
+    time.sleep(1)
+    for p, m in last_mtimes.items():
       try:
-        parsed_out = json.loads(output)
-        output = json.dumps(parsed_out, indent=2)
-        headers = {'X-Result-Type': 'json', 'X-Input-Format': input_format}
+        if os.path.getmtime(p) != m:
+          print(f'Reloading due to change in {os.path.basename(p)}...')
+          if before_restart is not None:
+            before_restart()
+          os.execv(sys.executable, [sys.executable] + sys.argv)
       except Exception:
-        headers = {'X-Result-Type': 'string', 'X-Input-Format': input_format}
+        continue
+
+def run_worker(conn):
+  global WRITER_CONN, HISTORY_LOCK
+  WRITER_CONN = conn
+  # A supervisor thread may have held the lock at fork time
+  HISTORY_LOCK = threading.Lock()
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  try:
+    ReusePortHTTPServer((HOST, PORT), JinjaHandler).serve_forever()
+  finally:
+    os._exit(1)
+
+def run_prefork(count, watched_files):
+  # Supervisor: warm everything workers can share, fork them, perform their
+  # history/settings writes and restart any worker that exits
+  if INPUT_FILE_CACHE is not None:
+    INPUT_FILE_CACHE.prewarm(input_files_dir())
+  precompile_templates()
+  os.makedirs(SHARED_RESULTS_DIR, exist_ok=True)
+  RESULT_STORE.directory = SHARED_RESULTS_DIR
+  # Keep the collector from touching (and so copying) the inherited objects
+  gc.freeze()
+  workers = {}
 
-      # Record
+  def spawn(index):
+    parent_conn, child_conn = Pipe()
+    pid = os.fork()
+    if pid == 0:
+      parent_conn.close()
+      run_worker(child_conn)
+    child_conn.close()
+    workers[pid] = (index, time.monotonic())
+    threading.Thread(target=serve_writes, args=(parent_conn,), daemon=True).start()
+
+  def stop_workers():
+    for pid in list(workers):
       try:
-        ts = datetime.datetime.utcnow().isoformat() + 'Z'
-        entry = {
-          'datetime': ts,
-          'input': base64.b64encode(json_text.encode('utf-8')).decode('ascii'),
-          'expr': base64.b64encode(expr.encode('utf-8')).decode('ascii')
-        }
-        try:
-          with open(JSON_HISTORY_PATH, 'r', encoding='utf-8') as hf:
-            hist = json.load(hf)
-        except Exception:
-          hist = []
-        hist.append(entry)
-        hist = hist[-MAX_ENTRIES:]
-        with open(JSON_HISTORY_PATH, 'w', encoding='utf-8') as hf:
-          json.dump(hist, hf, indent=2)
-      except Exception:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
         pass
 
-      self._send_headers(200, 'text/plain', headers)
-      self.wfile.write(output.encode())
-    except Exception as e:
-      self._send_headers(400, 'text/plain')
-      self.wfile.write(f'Jinja expression error: {e}'.encode())
-
-if __name__ == '__main__':
-  def watch_files(paths):
-    last_mtimes = {p: os.path.getmtime(p) for p in paths}
+  for index in range(count):
+    spawn(index)
+  threading.Thread(target=watch_files, args=(watched_files, stop_workers), daemon=True).start()
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  print(f"Server started at http://{HOST}:{PORT} with {count} workers")
+  try:
     while True:
-      time.sleep(1)
-      for p, m in last_mtimes.items():
-        try:
-          if os.path.getmtime(p) != m:
-            print(f'Reloading due to change in {os.path.basename(p)}...')
-            os.execv(sys.executable, [sys.executable] + sys.argv)
-        except Exception:
-          continue
+      pid, status = os.wait()
+      if pid not in workers:
+        continue
+      index, started = workers.pop(pid)
+      print(f'Worker {index} (pid {pid}) exited with status {status}, restarting...')
+      # Do not spin when a worker dies right after starting (e.g. port in use)
+      if time.monotonic() - started < 1:
+        time.sleep(1)
+      spawn(index)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    stop_workers()
 
+if __name__ == '__main__':
   files = [__file__, HTML_FILE_PATH, CONF_PATH]
+  workers = SERVER_WORKERS if SERVER_WORKERS > 0 else (os.cpu_count() or 1)
+  if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+    print('SO_REUSEPORT is not available on this platform, starting a single process')
+    workers = 1
+  if workers > 1:
+    run_prefork(workers, files)
+    sys.exit(0)
+
   threading.Thread(target=watch_files, args=(files,), daemon=True).start()
+  if INPUT_FILE_CACHE is not None:
+    threading.Thread(target=INPUT_FILE_CACHE.prewarm, args=(input_files_dir(),), daemon=True).start()
+  threading.Thread(target=precompile_templates, daemon=True).start()
   print(f"Server started at http://{HOST}:{PORT}")
-  HTTPServer((HOST, PORT), JinjaHandler).serve_forever()
+  ThreadingHTTPServer((HOST, PORT), JinjaHandler).serve_forever()
@@ -0,0 +1,49 @@
+// Input and result format detection for the Jinja2 Web Evaluator.
+// Loaded by the page as a plain script (the fallback when workers are not
+// available) and started as a Web Worker, so multi-MB documents are parsed
+// off the UI thread.
+
+function detectFormat(content) {
+  if (!content || !content.trim()) return 'application/json';
+
+  // Try to parse as JSON first
+  try {
+    JSON.parse(content);
+    return 'application/json';
+  } catch (e) {
+    // If JSON fails, check for YAML indicators
+    const trimmed = content.trim();
+    if (trimmed.includes(':') && !trimmed.startsWith('{') && !trimmed.startsWith('[')) {
+      return 'text/x-yaml';
+    }
+    return 'text/plain';
+  }
+}
+
+function detectResultFormat(content) {
+  if (!content || !content.trim()) return 'text/plain';
+
+  try {
+    JSON.parse(content);
+    return 'application/json';
+  } catch (e) {
+    // Check for XML
+    if (content.trim().startsWith('<') && content.trim().endsWith('>')) {
+      return 'application/xml';
+    }
+    // Check for YAML
+    if (content.includes(':') && !content.startsWith('{') && !content.startsWith('[')) {
+      return 'text/x-yaml';
+    }
+    return 'text/plain';
+  }
+}
+
+if (typeof WorkerGlobalScope !== 'undefined' && self instanceof WorkerGlobalScope) {
+  // Requests: {id, kind: 'input' | 'result', text}; replies: {id, kind, format, size}
+  self.onmessage = evt => {
+    const msg = evt.data;
+    const format = msg.kind === 'input' ? detectFormat(msg.text) : detectResultFormat(msg.text);
+    self.postMessage({ id: msg.id, kind: msg.kind, format, size: msg.text.length });
+  };
+}
@@ -0,0 +1,24 @@
+// "large" CodeMirror mode for multi-MB documents. It highlights strings,
+// numbers, literals, keys and comments one line at a time. No state is
+// carried between lines, so an edit never re-tokenizes the rest of the
+// document (unlike the javascript and yaml modes).
+(function(CodeMirror) {
+  CodeMirror.defineMode('large', () => ({
+    token(stream) {
+      if (stream.eatSpace()) return null;
+      const ch = stream.peek();
+      if (ch === '#' && (stream.sol() || /\s/.test(stream.string.charAt(stream.pos - 1)))) {
+        stream.skipToEnd();
+        return 'comment';
+      }
+      if (stream.match(/^"(?:[^"\\]|\\.)*"?/) || stream.match(/^'(?:[^']|'')*'?/)) {
+        return stream.match(/^\s*:/, false) ? 'property' : 'string';
+      }
+      if (stream.match(/^-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?(?![\w.])/)) return 'number';
+      if (stream.match(/^(?:true|false|null)(?![\w.-])/)) return 'atom';
+      if (stream.match(/^[\w.-]+(?=\s*:(?:\s|$))/)) return 'property';
+      if (!stream.eatWhile(/[^\s"'#:,[\]{}]/)) stream.next();
+      return null;
+    }
+  }));
+})(CodeMirror);
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Test for admission control on /render.
+Starts a copy of the server with tight limits on a spare port and checks the
+per-client rate limit, the bounded wait queue, the Retry-After responses, the
+/admission statistics, that /settings changes the limits and refuses
+invalid ones, and that invalid values in the configuration file fall back to
+the defaults instead of keeping the server down.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+PORT = 8766
+SERVER_URL = f"http://localhost:{PORT}"
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SLOW = "{% for i in range(100000) %}{% for j in range(100000) %}{% endfor %}{% endfor %}"
+CONF = ("[admission]\nrate = 2\nburst = 3\nmax_concurrent = 1\nqueue_size = 1\nqueue_timeout = 1\n\n"
+        "[render_budget]\nmax_seconds = 2\n")
+
+server = None
+
+def start_server(conf=CONF):
+    """Copy the application to a temporary directory and run it with tight limits."""
+    global server
+    if server is not None:
+        return server
+    work_dir = tempfile.mkdtemp(prefix='admission_test_')
+    with open(os.path.join(ROOT_DIR, 'jinja2_eval_web.py'), 'r', encoding='utf-8') as f:
+        source = f.read().replace('PORT = 8000', f'PORT = {PORT}', 1)
+    with open(os.path.join(work_dir, 'jinja2_eval_web.py'), 'w', encoding='utf-8') as f:
+        f.write(source)
+    shutil.copy(os.path.join(ROOT_DIR, 'jinja2_eval_web.html'), work_dir)
+    shutil.copytree(os.path.join(ROOT_DIR, 'jinja2_eval_web_static'), os.path.join(work_dir, 'jinja2_eval_web_static'))
+    with open(os.path.join(work_dir, 'jinja2_eval_web.conf'), 'w', encoding='utf-8') as f:
+        f.write(conf)
+
+    process = subprocess.Popen([sys.executable, 'jinja2_eval_web.py'], cwd=work_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = (process, work_dir)
+    atexit.register(stop_server)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(SERVER_URL + '/admission')
+            break
+        except Exception:
+            time.sleep(0.1)
+    return server
+
+def stop_server():
+    global server
+    if server is None:
+        return
+    process, work_dir = server
+    process.terminate()
+    process.wait(timeout=10)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    server = None
+
+def render(expr):
+    """Return (status, Retry-After) for a render of expr."""
+    data = urllib.parse.urlencode({'json': '{}', 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    try:
+        response = urllib.request.urlopen(req)
+        response.read()
+        return response.status, None
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, e.headers.get('Retry-After')
+
+def admission_stats():
+    return json.loads(urllib.request.urlopen(SERVER_URL + '/admission').read().decode('utf-8'))
+
+def test_rate_limit():
+    """Test that a client over its burst gets 429 with Retry-After and cache hits stay free."""
+    print("Testing per-client rate limit...")
+
+    try:
+        start_server()
+        # Fresh templates so every request has to render
+        results = [render(f'{{{{ {i} }}}} {time.time_ns()}') for i in range(5)]
+        statuses = [status for status, _ in results]
+        retry_after = results[-1][1]
+        all_ok = True
+        if statuses[:3] == [200, 200, 200] and statuses[3:] == [429, 429] and retry_after and int(retry_after) >= 1:
+            print(f"  ✅ Burst of 3 admitted, then 429 with Retry-After: {retry_after}")
+        else:
+            print(f"  ❌ Unexpected responses: {results}")
+            all_ok = False
+        if admission_stats()['rejected']['rate_limited'] >= 2:
+            print("  ✅ Rejections counted")
+        else:
+            print(f"  ❌ Unexpected stats: {admission_stats()}")
+            all_ok = False
+        time.sleep(1)
+        # One token is spent on the first render; the repeat is a cache hit
+        first, second = render('{{ "cached" }}'), render('{{ "cached" }}')
+        if first[0] == 200 and second[0] == 200:
+            print("  ✅ Cache hits are not charged")
+        else:
+            print(f"  ❌ Unexpected responses: {first}, {second}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing rate limit: {e}")
+        return False
+
+def test_queue():
+    """Test the concurrency cap, the bounded queue and its 503 responses."""
+    print("\nTesting concurrency cap and wait queue...")
+
+    try:
+        start_server()
+        # Let the client's bucket refill
+        time.sleep(2)
+        results = {}
+
+        def run(name, expr):
+            results[name] = render(expr)
+
+        slow = threading.Thread(target=run, args=('slow', SLOW))
+        waiting = threading.Thread(target=run, args=('waiting', f'{{{{ 1 }}}} {time.time_ns()}'))
+        slow.start()
+        time.sleep(0.3)
+        waiting.start()
+        time.sleep(0.3)
+        stats = admission_stats()
+        full = render(f'{{{{ 2 }}}} {time.time_ns()}')
+        slow.join()
+        waiting.join()
+
+        all_ok = True
+        if stats['active'] == 1 and stats['queued'] == 1:
+            print("  ✅ One render running, one queued")
+        else:
+            print(f"  ❌ Unexpected queue state: {stats}")
+            all_ok = False
+        if full[0] == 503 and full[1] and int(full[1]) >= 1:
+            print(f"  ✅ Queue full: 503 with Retry-After: {full[1]}")
+        else:
+            print(f"  ❌ Expected 503 for a full queue, got {full}")
+            all_ok = False
+        if results['waiting'][0] == 503 and results['slow'][0] == 400:
+            print("  ✅ Queued render timed out with 503 while the slow render held the slot")
+        else:
+            print(f"  ❌ Unexpected results: {results}")
+            all_ok = False
+        rejected = admission_stats()['rejected']
+        if rejected['queue_full'] >= 1 and rejected['queue_timeout'] >= 1:
+            print(f"  ✅ Rejections counted: {rejected}")
+        else:
+            print(f"  ❌ Unexpected stats: {rejected}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing queue: {e}")
+        return False
+
+def test_invalid_settings_rejected():
+    """Test that invalid limits are refused with 400 and neither applied nor saved."""
+    print("\nTesting invalid limits posted to /settings...")
+
+    try:
+        start_server()
+        before = admission_stats()['limits']
+        statuses = []
+        for values in ({'rate': 'fast'}, {'enabled': 'maybe'}, {'max_concurrent': '2.5'}):
+            data = urllib.parse.urlencode(dict(values, section='admission')).encode('utf-8')
+            try:
+                urllib.request.urlopen(urllib.request.Request(SERVER_URL + '/settings', data=data)).read()
+                statuses.append(200)
+            except urllib.error.HTTPError as e:
+                e.read()
+                statuses.append(e.code)
+        with open(os.path.join(server[1], 'jinja2_eval_web.conf'), 'r', encoding='utf-8') as f:
+            saved = f.read()
+        after = admission_stats()['limits']
+        if statuses == [400] * 3 and before == after and 'fast' not in saved and 'maybe' not in saved:
+            print("  ✅ Invalid values refused, limits and configuration file unchanged")
+            return True
+        print(f"  ❌ Unexpected: {statuses}, {before} -> {after}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing invalid settings: {e}")
+        return False
+
+def test_settings_update():
+    """Test that limits posted to /settings take effect."""
+    print("\nTesting limit changes through /settings...")
+
+    try:
+        start_server()
+        data = urllib.parse.urlencode({'section': 'admission', 'rate': '0', 'max_concurrent': '8'}).encode('utf-8')
+        urllib.request.urlopen(urllib.request.Request(SERVER_URL + '/settings', data=data)).read()
+        limits = admission_stats()['limits']
+        # The configuration file changed, so the server reloads; the limits
+        # must survive that too
+        time.sleep(1.5)
+        for _ in range(50):
+            try:
+                reloaded = admission_stats()['limits']
+                break
+            except Exception:
+                time.sleep(0.1)
+        statuses = [render(f'{{{{ {i} }}}} {time.time_ns()}')[0] for i in range(6)]
+        if limits == reloaded and limits['rate'] == 0 and limits['max_concurrent'] == 8 and statuses == [200] * 6:
+            print(f"  ✅ New limits applied and saved: {limits}")
+            return True
+        print(f"  ❌ Unexpected limits or responses: {limits}, {reloaded}, {statuses}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing settings: {e}")
+        return False
+
+def test_invalid_file_values():
+    """Test that a configuration file with invalid values still starts the server with the defaults."""
+    print("\nTesting invalid values in the configuration file...")
+
+    try:
+        stop_server()
+        start_server("[admission]\nrate = fast\n\n[render_budget]\nmax_seconds = thirty\n\n"
+                     "[server]\nkeep_alive_timeout = 0\n\n[output]\nchunk_size = x\n")
+        limits = admission_stats()['limits']
+        status, _ = render(f'{{{{ 1 }}}} {time.time_ns()}')
+        data = urllib.parse.urlencode({'json': '{}', 'expr': f'{{{{ 2 }}}} {time.time_ns()}'}).encode('utf-8')
+        response = urllib.request.urlopen(urllib.request.Request(SERVER_URL + '/render', data=data))
+        budget = json.loads(response.headers.get('X-Render-Budget', '{}'))
+        if status == 200 and limits['rate'] == 50 and budget.get('max_ms') == 30000:
+            print(f"  ✅ Server started with the defaults: rate {limits['rate']}, max_ms {budget['max_ms']}")
+            return True
+        print(f"  ❌ Unexpected: {status}, {limits}, {budget!r}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing invalid file values: {e}")
+        return False
+
+def run_all_tests():
+    """Run all admission control tests."""
+    print("=" * 60)
+    print("ADMISSION CONTROL TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Rate Limit", test_rate_limit),
+        ("Queue", test_queue),
+        ("Invalid Settings Rejected", test_invalid_settings_rejected),
+        ("Settings Update", test_settings_update),
+        ("Invalid File Values", test_invalid_file_values)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    stop_server()
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Test for the on-demand diagnostic endpoints.
+Checks that /debug/ is hidden on the default server, then starts a copy with
+diagnostics enabled on a spare port and checks the token, cProfile and
+sampling sessions over live renders, tracemalloc snapshots and the thread
+dump.
+"""
+
+import atexit
+import json
+import marshal
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+import websocket_render_test
+
+# Test configuration
+DEFAULT_SERVER_URL = "http://localhost:8000"
+PORT = 8767
+SERVER_URL = f"http://localhost:{PORT}"
+TOKEN = "test-token"
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+server = None
+
+def start_server():
+    """Copy the application to a temporary directory and run it with diagnostics enabled."""
+    global server
+    if server is not None:
+        return server
+    work_dir = tempfile.mkdtemp(prefix='diagnostics_test_')
+    with open(os.path.join(ROOT_DIR, 'jinja2_eval_web.py'), 'r', encoding='utf-8') as f:
+        source = f.read().replace('PORT = 8000', f'PORT = {PORT}', 1)
+    with open(os.path.join(work_dir, 'jinja2_eval_web.py'), 'w', encoding='utf-8') as f:
+        f.write(source)
+    shutil.copy(os.path.join(ROOT_DIR, 'jinja2_eval_web.html'), work_dir)
+    shutil.copytree(os.path.join(ROOT_DIR, 'jinja2_eval_web_static'), os.path.join(work_dir, 'jinja2_eval_web_static'))
+    with open(os.path.join(work_dir, 'jinja2_eval_web.conf'), 'w', encoding='utf-8') as f:
+        f.write(f"[diagnostics]\nenabled = true\ntoken = {TOKEN}\nsample_interval_ms = 2\n")
+
+    process = subprocess.Popen([sys.executable, 'jinja2_eval_web.py'], cwd=work_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = (process, work_dir)
+    atexit.register(stop_server)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(SERVER_URL + '/history/size')
+            break
+        except Exception:
+            time.sleep(0.1)
+    return server
+
+def stop_server():
+    global server
+    if server is None:
+        return
+    process, work_dir = server
+    process.terminate()
+    process.wait(timeout=10)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    server = None
+
+def debug(path, params=None, post=False, token=TOKEN, base=SERVER_URL):
+    """Return (status, body bytes) of a diagnostics request."""
+    data = urllib.parse.urlencode(params or {}).encode('utf-8') if post else None
+    url = base + path + ('' if post or not params else '?' + urllib.parse.urlencode(params))
+    req = urllib.request.Request(url, data=data)
+    if token:
+        req.add_header('X-Diagnostics-Token', token)
+    try:
+        response = urllib.request.urlopen(req)
+        return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def render(expr):
+    data = urllib.parse.urlencode({'json': '{"hosts": ["a", "b", "c"]}', 'expr': expr}).encode('utf-8')
+    urllib.request.urlopen(urllib.request.Request(SERVER_URL + '/render', data=data)).read()
+
+def test_disabled_by_default():
+    """Test that the default server hides /debug/ and keeps its settings read-only."""
+    print("Testing diagnostics on the default server...")
+
+    try:
+        status, _ = debug('/debug/threads', token=None, base=DEFAULT_SERVER_URL)
+        data = urllib.parse.urlencode({'section': 'diagnostics', 'enabled': 'true'}).encode('utf-8')
+        try:
+            urllib.request.urlopen(urllib.request.Request(DEFAULT_SERVER_URL + '/settings', data=data))
+            settings_status = 200
+        except urllib.error.HTTPError as e:
+            settings_status = e.code
+        if status == 404 and settings_status == 403:
+            print("  ✅ /debug/ returns 404 and /settings cannot enable it")
+            return True
+        print(f"  ❌ Unexpected statuses: /debug/threads {status}, /settings {settings_status}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing default server: {e}")
+        return False
+
+def test_token_required():
+    """Test that requests without the right token are refused and the token is not served."""
+    print("\nTesting diagnostics token...")
+
+    try:
+        start_server()
+        missing, _ = debug('/debug/threads', token=None)
+        wrong, _ = debug('/debug/threads', token='wrong')
+        settings = json.loads(urllib.request.urlopen(SERVER_URL + '/settings?section=diagnostics').read().decode('utf-8'))
+        if missing == 403 and wrong == 403 and settings.get('token') != TOKEN:
+            print("  ✅ Missing and wrong tokens refused, token withheld from /settings")
+            return True
+        print(f"  ❌ Unexpected: {missing}, {wrong}, {settings}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing token: {e}")
+        return False
+
+def test_cprofile_session():
+    """Test a cProfile session over live renders, next to an open WebSocket, in text and raw form."""
+    print("\nTesting cProfile session...")
+
+    try:
+        start_server()
+        all_ok = True
+        # An open live-render session, as the editor keeps, is one long request
+        websocket_render_test.PORT = PORT
+        for output_format in ('text', 'raw'):
+            status, _ = debug('/debug/profile/start', {'mode': 'cprofile'}, post=True)
+            again, _ = debug('/debug/profile/start', {'mode': 'cprofile'}, post=True)
+            client = websocket_render_test.WebSocketClient()
+            client.send({'seq': 1, 'json': '{}', 'expr': '{{ 1 }}'})
+            client.receive()
+            for i in range(5):
+                render(f'{{% for h in data.hosts %}}{{{{ h | upper }}}}{{% endfor %}} {i} {time.time_ns()}')
+            client.close()
+            status_info = json.loads(debug('/debug/profile')[1])
+            stop, body = debug('/debug/profile/stop', {'format': output_format, 'limit': '30'}, post=True)
+            if output_format == 'text':
+                text = body.decode('utf-8')
+                ok = status == 200 and again == 409 and stop == 200 and status_info['requests'] >= 5 \
+                    and 'do_POST' in text and 'function calls' in text
+            else:
+                stats = marshal.loads(body)
+                ok = stop == 200 and any(func[2] == 'render_output' for func in stats)
+            if ok:
+                print(f"  ✅ {output_format} report covers the profiled renders")
+            else:
+                print(f"  ❌ Unexpected {output_format} session: {status}, {again}, {status_info}, {stop}, {body[:200]!r}")
+                all_ok = False
+        stopped, _ = debug('/debug/profile/stop', post=True)
+        if stopped != 409:
+            print(f"  ❌ Stopping without a session returned {stopped}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing cProfile session: {e}")
+        return False
+
+def test_sampling_session():
+    """Test that the sampler returns collapsed stacks of the render threads."""
+    print("\nTesting sampling session...")
+
+    try:
+        start_server()
+        debug('/debug/profile/start', {'mode': 'sample'}, post=True)
+        render('{% for i in range(100000) %}{% for j in range(5) %}{% endfor %}{% endfor %}' + str(time.time_ns()))
+        status, body = debug('/debug/profile/stop', post=True)
+        lines = body.decode('utf-8').splitlines()
+        counts_ok = all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+        if status == 200 and lines and counts_ok and any('render_output' in line for line in lines):
+            print(f"  ✅ {len(lines)} distinct stacks, render threads sampled")
+            return True
+        print(f"  ❌ Unexpected output: {status}, {lines[:3]}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing sampling session: {e}")
+        return False
+
+def test_tracemalloc_and_threads():
+    """Test tracemalloc top-N snapshots, snapshot comparison and the thread dump."""
+    print("\nTesting tracemalloc snapshots and thread dump...")
+
+    try:
+        start_server()
+        all_ok = True
+        before, _ = debug('/debug/tracemalloc')
+        debug('/debug/tracemalloc/start', {'frames': '5'}, post=True)
+        top = json.loads(debug('/debug/tracemalloc', {'limit': '5'})[1])
+        render('{{ data.hosts | length }}')
+        diff = json.loads(debug('/debug/tracemalloc', {'limit': '5', 'compare': '1'})[1])
+        debug('/debug/tracemalloc/stop', post=True)
+        if before == 409 and len(top['top']) == 5 and top['frames'] == 5 and 'size_diff' in diff['top'][0]:
+            print(f"  ✅ Top 5 allocation sites of {top['traced']:,} traced bytes, comparison available")
+        else:
+            print(f"  ❌ Unexpected snapshots: {before}, {top}, {diff}")
+            all_ok = False
+
+        status, body = debug('/debug/threads')
+        dump = body.decode('utf-8')
+        if status == 200 and 'Thread MainThread' in dump and 'serve_forever' in dump and 'thread_dump' in dump:
+            print("  ✅ Thread dump lists every thread with its stack")
+        else:
+            print(f"  ❌ Unexpected thread dump: {status}, {dump[:200]!r}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing tracemalloc and threads: {e}")
+        return False
+
+def run_all_tests():
+    """Run all diagnostics tests."""
+    print("=" * 60)
+    print("DIAGNOSTICS TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Disabled By Default", test_disabled_by_default),
+        ("Token Required", test_token_required),
+        ("cProfile Session", test_cprofile_session),
+        ("Sampling Session", test_sampling_session),
+        ("Tracemalloc And Threads", test_tracemalloc_and_threads)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    stop_server()
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Test for the memoized Ansible filters and the json_query filter.
+Renders loops that call the same filter with the same arguments and checks
+the cache statistics, the JMESPath expression cache, the byte accounting of
+cached results and that cached containers are not shared between calls.
+"""
+
+import json
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+
+def cache_stats():
+    return json.loads(urllib.request.urlopen(SERVER_URL + '/filter-cache').read().decode('utf-8'))
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    return urllib.request.urlopen(req).read().decode('utf-8')
+
+def test_cache_stats():
+    """Test that the statistics endpoint lists the memoized filters."""
+    print("Testing /filter-cache endpoint...")
+
+    try:
+        stats = cache_stats()
+        filters = stats.get('filters', {})
+        if stats.get('enabled') and 'regex_replace' in filters and 'from_yaml' in filters and 'jmespath' in stats:
+            print(f"  ✅ {len(filters)} memoized filters, max {stats['max_entries']} entries and {stats['max_bytes']} bytes")
+            return True
+        print(f"  ❌ Unexpected stats: {stats}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error reading filter cache stats: {e}")
+        return False
+
+def test_repeated_calls_hit():
+    """Test that a loop repeating the same calls is served from the cache."""
+    print("\nTesting memoized calls in a loop...")
+
+    try:
+        # A fresh pattern so earlier runs cannot have cached these calls
+        tag = str(time.time_ns())
+        hosts = [f'web-{i % 5}.{tag}.example.com' for i in range(100)]
+        before = cache_stats()['filters']['regex_replace']
+        output = render(json.dumps({'hosts': hosts}),
+                        "{% for h in data.hosts %}{{ h | regex_replace('\\\\.example\\\\.com$', '') }} {% endfor %}")
+        after = cache_stats()['filters']['regex_replace']
+        expected = ' '.join(h[:-len('.example.com')] for h in hosts) + ' '
+        hits = after['hits'] - before['hits']
+        misses = after['misses'] - before['misses']
+        if output == expected and misses == 5 and hits == 95:
+            print(f"  ✅ Output unchanged, {misses} misses and {hits} hits")
+            return True
+        print(f"  ❌ Unexpected output or counts: {misses} misses, {hits} hits, {output[:80]!r}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing memoized calls: {e}")
+        return False
+
+def test_cached_results_not_shared():
+    """Test that a container result modified by a template does not leak into later calls."""
+    print("\nTesting isolation of cached containers...")
+
+    try:
+        output = render('{}', "{% for i in range(3) %}{% set d = 'x: [1]' | from_yaml %}"
+                              "{{ d.x | length }}{{ d.x.append(i) or '' }}{% endfor %}")
+        if output == '111':
+            print("  ✅ Each call got its own copy")
+            return True
+        print(f"  ❌ Cached result was shared: {output!r}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing cached containers: {e}")
+        return False
+
+def test_cache_size_counted():
+    """Test that a large cached result is counted in bytes against max_bytes."""
+    print("\nTesting cache size accounting...")
+
+    try:
+        # About 50000 characters of YAML (under max_value_size), from the input
+        # so Jinja cannot fold the call at compile time
+        snippet = f'run: {time.time_ns()}\nitems:\n' + ''.join(f'  - item-{i:06d}\n' for i in range(3000))
+        before = cache_stats()
+        output = render(json.dumps({'snippet': snippet}),
+                        "{% for i in range(3) %}{{ (data.snippet | from_yaml)['items'] | length }};{% endfor %}")
+        after = cache_stats()
+        grown = after['bytes'] - before['bytes']
+        if output == '3000;' * 3 and grown >= len(snippet) and after['bytes'] <= after['max_bytes']:
+            print(f"  ✅ Parsed document cached as {grown} bytes, total {after['bytes']} of {after['max_bytes']}")
+            return True
+        print(f"  ❌ Unexpected output or sizes: {output[:40]!r}, {before['bytes']} -> {after['bytes']}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing cache size: {e}")
+        return False
+
+def test_json_query():
+    """Test json_query results, expression caching and error reporting."""
+    print("\nTesting json_query...")
+
+    try:
+        all_ok = True
+        # A fresh input so the render cache cannot answer without running the filter
+        data = json.dumps({'run': time.time_ns(),
+                           'hosts': [{'name': 'a', 'up': True}, {'name': 'b', 'up': False}, {'name': 'c', 'up': True}]})
+        before = cache_stats()['jmespath']
+        output = render(data, "{% for i in range(10) %}{{ data.hosts | json_query('[?up].name') | join(',') }};{% endfor %}")
+        after = cache_stats()['jmespath']
+        if output == 'a,c;' * 10 and after['hits'] - before['hits'] >= 9:
+            print("  ✅ Query results correct, expression compiled once")
+        else:
+            print(f"  ❌ Unexpected output or stats: {output!r}, {before} -> {after}")
+            all_ok = False
+
+        try:
+            render(data, "{{ data | json_query('[') }}")
+            print("  ❌ Invalid expression accepted")
+            all_ok = False
+        except urllib.error.HTTPError as e:
+            message = e.read().decode('utf-8')
+            if e.code == 400 and 'JMESPathError' in message:
+                print("  ✅ Invalid expression reported")
+            else:
+                print(f"  ❌ Unexpected error: {e.code} {message}")
+                all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing json_query: {e}")
+        return False
+
+def run_all_tests():
+    """Run all filter cache tests."""
+    print("=" * 60)
+    print("FILTER CACHE TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Cache Stats", test_cache_stats),
+        ("Repeated Calls Hit", test_repeated_calls_hit),
+        ("Cached Results Not Shared", test_cached_results_not_shared),
+        ("Cache Size Counted", test_cache_size_counted),
+        ("JSON Query", test_json_query)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
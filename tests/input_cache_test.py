@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Test for the persistent cache of parsed input files.
+Writes a YAML file into the input directory, loads it like the UI does and
+checks that renders of its content are served from the cache, and that
+changing the file replaces the entry. Also checks that forged or leftover
+pickle entries are never loaded at startup and that /settings keeps the
+template library out of the cache directories.
+"""
+
+import json
+import os
+import pickle
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+INPUT_DIR = os.path.join(ROOT_DIR, 'jinja2_eval_web_inputs')
+CACHE_DIR = os.path.join(ROOT_DIR, 'jinja2_eval_web_cache')
+FILENAME = '_input_cache_test.yaml'
+
+def cache_stats():
+    return json.loads(urllib.request.urlopen(SERVER_URL + '/input-cache').read().decode('utf-8'))
+
+def load_file():
+    url = SERVER_URL + '/input-file-content?' + urllib.parse.urlencode({'filename': FILENAME})
+    return urllib.request.urlopen(url).read().decode('utf-8')
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    return urllib.request.urlopen(req).read().decode('utf-8')
+
+def wait_for_store(previous_stores):
+    for _ in range(50):
+        if cache_stats().get('stores', 0) > previous_stores:
+            return True
+        time.sleep(0.1)
+    return False
+
+def write_file(region):
+    with open(os.path.join(INPUT_DIR, FILENAME), 'w', encoding='utf-8') as f:
+        f.write(f"region: {region}\nhosts:\n  - web1\n  - web2\n")
+
+def test_cache_enabled():
+    """Test that the cache statistics endpoint reports an enabled cache."""
+    print("Testing /input-cache endpoint...")
+
+    try:
+        stats = cache_stats()
+        if stats.get('enabled') and 'entries' in stats and 'max_bytes' in stats:
+            print(f"  ✅ Cache enabled: {stats['entries']} entries, {stats['bytes']} bytes")
+            return True
+        print(f"  ❌ Unexpected stats: {stats}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error reading cache stats: {e}")
+        return False
+
+def test_file_render_uses_cache():
+    """Test that rendering a loaded file's content is a cache hit and that edits invalidate it."""
+    print("\nTesting renders of cached input files...")
+
+    path = os.path.join(INPUT_DIR, FILENAME)
+    try:
+        all_ok = True
+        expr = '{{ data.region }} {{ data.hosts | join(",") }}'
+
+        write_file('eu-west-1')
+        stores = cache_stats()['stores']
+        content = load_file()
+        if not wait_for_store(stores):
+            print("  ❌ Loaded file was not stored in the cache")
+            return False
+        hits = cache_stats()['hits']
+        output = render(content, expr)
+        if output == 'eu-west-1 web1,web2' and cache_stats()['hits'] == hits + 1:
+            print("  ✅ File content rendered from the cache")
+        else:
+            print(f"  ❌ Expected a cache hit, got {output!r} and {cache_stats()}")
+            all_ok = False
+
+        # Same size, different content: the entry must be replaced
+        time.sleep(0.01)
+        write_file('eu-west-2')
+        stores = cache_stats()['stores']
+        entries = cache_stats()['entries']
+        content = load_file()
+        if not wait_for_store(stores):
+            print("  ❌ Changed file was not stored again")
+            return False
+        output = render(content, expr)
+        if output == 'eu-west-2 web1,web2' and cache_stats()['entries'] == entries:
+            print("  ✅ Changed file replaced its cache entry")
+        else:
+            print(f"  ❌ Unexpected output or entry count: {output!r}, {cache_stats()}")
+            all_ok = False
+
+        hits = cache_stats()['hits']
+        render(content + '\nextra: 1\n', expr)
+        if cache_stats()['hits'] == hits:
+            print("  ✅ Edited text is parsed, not served from the cache")
+        else:
+            print("  ❌ Edited text was served from the cache")
+            all_ok = False
+        return all_ok
+    except urllib.error.HTTPError as e:
+        print(f"  ❌ Request failed with {e.code}: {e.read().decode()}")
+        return False
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+class Marker:
+    """Unpickling this creates the marker file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (open, (self.path, 'w'))
+
+def wait_for_restart():
+    time.sleep(1.5)
+    for _ in range(100):
+        try:
+            stats = cache_stats()
+            if not stats.get('warming'):
+                return stats
+        except Exception:
+            pass
+        time.sleep(0.1)
+    return None
+
+def test_forged_entries_not_loaded():
+    """Test that a planted pickle and an unsigned entry are dropped unread at startup."""
+    print("\nTesting forged cache entries...")
+
+    marker = os.path.join(CACHE_DIR, '_forged_marker')
+    planted = os.path.join(CACHE_DIR, 'evil.pickle')
+    forged = os.path.join(CACHE_DIR, '0' * 32 + '.entry')
+    try:
+        with open(planted, 'wb') as f:
+            pickle.dump(Marker(marker), f, 0)
+        with open(forged, 'wb') as f:
+            f.write(os.urandom(32) + pickle.dumps(Marker(marker), 0))
+        # A change of the configuration file restarts the server
+        os.utime(os.path.join(ROOT_DIR, 'jinja2_eval_web.conf'))
+        if wait_for_restart() is None:
+            print("  ❌ Server did not come back")
+            return False
+        if not os.path.exists(marker) and not os.path.exists(planted) and not os.path.exists(forged):
+            print("  ✅ Planted pickle and unsigned entry removed without being loaded")
+            return True
+        print(f"  ❌ Marker {os.path.exists(marker)}, pickle {os.path.exists(planted)}, entry {os.path.exists(forged)}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing forged entries: {e}")
+        return False
+    finally:
+        for path in (marker, planted, forged):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_overlapping_directories_refused():
+    """Test that /settings cannot put the template library and a cache directory inside each other."""
+    print("\nTesting overlapping directory settings...")
+
+    changes = [
+        {'section': 'templates', 'directory': 'jinja2_eval_web_cache'},
+        {'section': 'templates', 'directory': '/'},
+        {'section': 'templates', 'bytecode_cache': 'jinja2_eval_web_templates/bytecode'},
+        {'section': 'input_cache', 'directory': 'jinja2_eval_web_templates'},
+    ]
+    statuses = []
+    try:
+        for change in changes:
+            data = urllib.parse.urlencode(change).encode('utf-8')
+            try:
+                urllib.request.urlopen(urllib.request.Request(SERVER_URL + '/settings', data=data)).read()
+                statuses.append(200)
+            except urllib.error.HTTPError as e:
+                e.read()
+                statuses.append(e.code)
+        settings = json.loads(urllib.request.urlopen(SERVER_URL + '/settings?section=templates').read().decode('utf-8'))
+        if statuses == [400] * len(changes) and settings.get('directory', 'jinja2_eval_web_templates') == 'jinja2_eval_web_templates':
+            print("  ✅ Overlapping directories refused and not saved")
+            return True
+        print(f"  ❌ Unexpected: {statuses}, {settings}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing directory settings: {e}")
+        return False
+
+def run_all_tests():
+    """Run all input cache tests."""
+    print("=" * 60)
+    print("INPUT FILE CACHE TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Cache Enabled", test_cache_enabled),
+        ("File Render Uses Cache", test_file_render_uses_cache),
+        ("Forged Entries Not Loaded", test_forged_entries_not_loaded),
+        ("Overlapping Directories Refused", test_overlapping_directories_refused)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
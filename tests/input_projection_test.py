@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Test for template input projection.
+Verifies the paths reported in X-Input-Paths and that projected renders
+produce the same output as rendering against the full document.
+"""
+
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+
+INVENTORY_YAML = """
+hosts:
+  - name: web1
+    ip: 10.0.0.1
+  - name: web2
+    ip: 10.0.0.2
+vars:
+  region: eu-west-1
+  owner: ops
+  nested:
+    deep: value
+unused:
+  blob: [1, 2, 3]
+"""
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    response = urllib.request.urlopen(req)
+    return response.read().decode('utf-8'), response.headers
+
+def test_projected_paths():
+    """Test the reported paths for static and dynamic templates."""
+    print("Testing reported input paths...")
+
+    cases = [
+        ('{% for h in data.hosts %}{{ h.name }} {% endfor %}{{ data.vars.region }}',
+         'data.hosts, data.vars.region', 'web1 web2 eu-west-1'),
+        ('{{ data["vars"]["nested"].deep }}', 'data.vars.nested.deep', 'value'),
+        ('{{ data.vars.keys() | list | sort | join(",") }}', 'data.vars', 'nested,owner,region'),
+        ('{{ data | length }}', 'data', '3'),
+        ('{% set k = "vars" %}{{ data[k].owner }}', 'data', 'ops'),
+        ('static text', '-', 'static text'),
+    ]
+
+    all_ok = True
+    for expr, expected_paths, expected_output in cases:
+        try:
+            output, headers = render(INVENTORY_YAML, expr)
+            paths = headers.get('X-Input-Paths')
+            if paths == expected_paths and output.strip() == expected_output:
+                print(f"  ✅ {expr}: {paths}")
+            else:
+                print(f"  ❌ {expr}: got paths {paths!r}, output {output!r}")
+                all_ok = False
+        except urllib.error.HTTPError as e:
+            print(f"  ❌ {expr}: render failed with {e.code}: {e.read().decode()}")
+            all_ok = False
+    return all_ok
+
+def test_missing_path_still_errors():
+    """Test that referencing a missing key fails the same way as without projection."""
+    print("\nTesting missing key on projected input...")
+
+    try:
+        render('{"a": {"b": 1}}', '{{ data.a.c }}')
+        print("  ❌ Expected 400 for undefined key")
+        return False
+    except urllib.error.HTTPError as e:
+        body = e.read().decode()
+        if e.code == 400 and 'Jinja expression error' in body:
+            print("  ✅ Undefined key still reported")
+            return True
+        print(f"  ❌ Unexpected error: {e.code} {body}")
+        return False
+
+def run_all_tests():
+    """Run all input projection tests."""
+    print("=" * 60)
+    print("INPUT PROJECTION TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Projected Paths", test_projected_paths),
+        ("Missing Path Still Errors", test_missing_path_still_errors)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Test for large-output handling.
+Verifies outputs above the configured size limit come back as a preview
+with a handle, and that the full text can be fetched in chunks or downloaded.
+"""
+
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+
+# Roughly 2.4 MB of output, above the default 1 MB inline limit
+LARGE_TEMPLATE = '{% for i in range(300) %}{% for j in range(1000) %}{{ "%07d" % (i * 1000 + j) }}\n{% endfor %}{% endfor %}'
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    response = urllib.request.urlopen(req)
+    return response.read().decode('utf-8'), response.headers
+
+def expected_output():
+    return ''.join(f'{n:07d}\n' for n in range(300000))
+
+def test_small_output_inline():
+    """Test that small outputs are returned whole without a handle."""
+    print("Testing small output...")
+
+    try:
+        output, headers = render('{"a": 1}', '{{ data.a }}')
+        if output == '1' and headers.get('X-Result-Truncated') is None:
+            print("  ✅ Small output returned inline")
+            return True
+        print(f"  ❌ Unexpected response: {output!r} {dict(headers)}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing small output: {e}")
+        return False
+
+def test_large_output_chunks():
+    """Test that a large output is truncated and can be reassembled from chunks."""
+    print("\nTesting large output preview and chunked fetch...")
+
+    try:
+        preview, headers = render('{}', LARGE_TEMPLATE)
+        if headers.get('X-Result-Truncated') != 'true':
+            print("  ❌ Large output was not truncated")
+            return False
+
+        result_id = headers['X-Result-Id']
+        size = int(headers['X-Result-Size'])
+        offset = int(headers['X-Result-Next'])
+        print(f"  ✅ Preview of {len(preview)} chars for a {size} char result")
+
+        parts = [preview]
+        requests = 0
+        while offset < size:
+            response = urllib.request.urlopen(f"{SERVER_URL}/result?id={result_id}&offset={offset}")
+            parts.append(response.read().decode('utf-8'))
+            offset = int(response.headers['X-Result-Next'])
+            requests += 1
+
+        if ''.join(parts) == expected_output():
+            print(f"  ✅ Full result reassembled from {requests} chunk requests")
+            return True
+        print("  ❌ Reassembled result differs from the expected output")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing chunked fetch: {e}")
+        return False
+
+def test_large_output_download():
+    """Test that the full result can be downloaded in one request."""
+    print("\nTesting full result download...")
+
+    try:
+        _, headers = render('{}', LARGE_TEMPLATE)
+        response = urllib.request.urlopen(f"{SERVER_URL}/result?id={headers['X-Result-Id']}&download=1")
+        body = response.read().decode('utf-8')
+        disposition = response.headers.get('Content-Disposition', '')
+
+        if body == expected_output() and disposition.startswith('attachment'):
+            print("  ✅ Full result downloaded as attachment")
+            return True
+        print(f"  ❌ Download mismatch (disposition: {disposition})")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing download: {e}")
+        return False
+
+def test_unknown_result():
+    """Test that unknown handles return 404."""
+    print("\nTesting unknown result handle...")
+
+    try:
+        urllib.request.urlopen(f"{SERVER_URL}/result?id=0123456789abcdef")
+        print("  ❌ Expected 404 for unknown handle")
+        return False
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            print("  ✅ Unknown handle returns 404")
+            return True
+        print(f"  ❌ Expected 404, got {e.code}")
+        return False
+
+def run_all_tests():
+    """Run all large output tests."""
+    print("=" * 60)
+    print("LARGE OUTPUT TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Small Output Inline", test_small_output_inline),
+        ("Large Output Chunks", test_large_output_chunks),
+        ("Large Output Download", test_large_output_download),
+        ("Unknown Result", test_unknown_result)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Test for lazy JSON input.
+Renders templates against a document large enough to be indexed lazily and
+checks the output matches the same data rendered from a small document.
+"""
+
+import json
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+# Above the default [input] lazy_json_min_size
+PADDING_ITEMS = 20000
+
+SMALL_DOC = {
+    "hosts": [{"name": "web1", "port": 80}, {"name": "web2", "port": 8080}],
+    "vars": {"region": "eu-west-1", "tags": {"env": "prod"}, "ports": [3, 1, 2]},
+    "_meta": {"hidden": True}
+}
+
+def large_doc():
+    doc = dict(SMALL_DOC)
+    doc["padding"] = [{"id": i, "text": "x" * 40, "nested": {"list": [i, "[{\"}]"]}} for i in range(PADDING_ITEMS)]
+    return json.dumps(doc)
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    response = urllib.request.urlopen(req)
+    return response.read().decode('utf-8'), response.headers
+
+def test_lazy_matches_eager():
+    """Test that lazily indexed input renders like fully decoded input."""
+    print("Testing lazy input against eager input...")
+
+    big = large_doc()
+    small = json.dumps(SMALL_DOC)
+    exprs = [
+        '{{ data.vars.region }}',
+        '{{ data.hosts | map(attribute="name") | join(",") }}',
+        '{{ data.hosts[-1].port + data.vars.ports | sum }}',
+        '{{ data.vars | to_json }}',
+        '{{ data.vars | to_nice_yaml }}',
+        '{{ data.vars.tags | combine({"team": "ops"}) | dict2items }}',
+        '{% for k, v in data.vars.items() %}{{ k }}={{ v }};{% endfor %}',
+        '{{ data["_meta"].hidden }} {{ "region" in data.vars }} {{ data.vars.ports | sort }}',
+        '{{ data.hosts }}',
+        '{{ [0] + data.vars.ports }} {{ ([0] + data.hosts) | length }}',
+    ]
+
+    all_ok = True
+    for expr in exprs:
+        try:
+            expected, _ = render(small, expr)
+            output, headers = render(big, expr)
+            if output == expected and headers.get('X-Input-Format') == 'JSON':
+                print(f"  ✅ {expr}")
+            else:
+                print(f"  ❌ {expr}: got {output!r}, expected {expected!r}")
+                all_ok = False
+        except urllib.error.HTTPError as e:
+            print(f"  ❌ {expr}: render failed with {e.code}: {e.read().decode()}")
+            all_ok = False
+    return all_ok
+
+def test_deferred_syntax_error():
+    """Test that a syntax error inside a container read by the template is an input error."""
+    print("\nTesting syntax error inside a lazily indexed container...")
+
+    big = large_doc().replace('"env": "prod"', '"env" "prod"')
+    try:
+        render(big, '{{ data.vars.tags.env }}')
+        print("  ❌ Expected 400 for malformed input")
+        return False
+    except urllib.error.HTTPError as e:
+        body = e.read().decode()
+        if e.code == 400 and body.startswith('Input parsing error'):
+            print(f"  ✅ Reported: {body}")
+            return True
+        print(f"  ❌ Unexpected error: {e.code} {body}")
+        return False
+
+def test_unterminated_nested_string():
+    """Test that an unclosed string inside a nested container is an input error, not a hang."""
+    print("\nTesting unterminated string inside a nested container...")
+
+    # What the editor holds right after typing an opening quote into a list
+    big = '{"padding": "' + 'x' * 1100000 + '", "tail": {"a": [" ]}}'
+    data = urllib.parse.urlencode({'json': big, 'expr': '{{ data.tail }}'}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    try:
+        urllib.request.urlopen(req, timeout=30)
+        print("  ❌ Expected 400 for malformed input")
+        return False
+    except urllib.error.HTTPError as e:
+        body = e.read().decode()
+        if e.code == 400 and body.startswith('Input parsing error'):
+            print("  ✅ Reported as an input error")
+            return True
+        print(f"  ❌ Unexpected error: {e.code} {body}")
+        return False
+    except Exception as e:
+        print(f"  ❌ No answer from the server: {e}")
+        return False
+
+def run_all_tests():
+    """Run all lazy JSON tests."""
+    print("=" * 60)
+    print("LAZY JSON INPUT TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Lazy Matches Eager", test_lazy_matches_eager),
+        ("Deferred Syntax Error", test_deferred_syntax_error),
+        ("Unterminated Nested String", test_unterminated_nested_string)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
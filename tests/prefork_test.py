@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Test for the pre-fork server mode.
+Starts a copy of the server with several workers on a spare port and checks
+that history writes from all workers land in one file, truncated results can
+be fetched from any worker and a killed worker is replaced.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+PORT = 8765
+WORKERS = 3
+SERVER_URL = f"http://localhost:{PORT}"
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+server = None
+
+def start_server():
+    """Copy the application to a temporary directory and run it in pre-fork mode."""
+    global server
+    if server is not None:
+        return server
+    work_dir = tempfile.mkdtemp(prefix='prefork_test_')
+    with open(os.path.join(ROOT_DIR, 'jinja2_eval_web.py'), 'r', encoding='utf-8') as f:
+        source = f.read().replace('PORT = 8000', f'PORT = {PORT}', 1)
+    with open(os.path.join(work_dir, 'jinja2_eval_web.py'), 'w', encoding='utf-8') as f:
+        f.write(source)
+    shutil.copy(os.path.join(ROOT_DIR, 'jinja2_eval_web.html'), work_dir)
+    shutil.copytree(os.path.join(ROOT_DIR, 'jinja2_eval_web_static'), os.path.join(work_dir, 'jinja2_eval_web_static'))
+    with open(os.path.join(work_dir, 'jinja2_eval_web.conf'), 'w', encoding='utf-8') as f:
+        f.write(f"[server]\nworkers = {WORKERS}\n\n[output]\nmax_inline_size = 1000\nchunk_size = 500\n")
+
+    process = subprocess.Popen([sys.executable, 'jinja2_eval_web.py'], cwd=work_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = (process, work_dir)
+    atexit.register(stop_server)
+    for _ in range(100):
+        if len(worker_pids()) == WORKERS:
+            try:
+                urllib.request.urlopen(SERVER_URL + '/history/size')
+                break
+            except Exception:
+                pass
+        time.sleep(0.1)
+    return server
+
+def stop_server():
+    global server
+    if server is None:
+        return
+    process, work_dir = server
+    process.send_signal(signal.SIGTERM)
+    process.wait(timeout=10)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    server = None
+
+def worker_pids():
+    process = server[0]
+    try:
+        with open(f'/proc/{process.pid}/task/{process.pid}/children', 'r') as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    return urllib.request.urlopen(req)
+
+def history_size():
+    return json.loads(urllib.request.urlopen(SERVER_URL + '/history/size').read().decode('utf-8'))['size']
+
+def test_workers_started():
+    """Test that the supervisor forks the configured number of workers."""
+    print("Testing worker processes...")
+
+    try:
+        start_server()
+        pids = worker_pids()
+        if len(pids) == WORKERS:
+            print(f"  ✅ {WORKERS} workers running: {pids}")
+            return True
+        print(f"  ❌ Expected {WORKERS} workers, found {pids}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error starting server: {e}")
+        return False
+
+def test_single_history_writer():
+    """Test that concurrent renders on all workers are all recorded in history."""
+    print("\nTesting history writes from all workers...")
+
+    try:
+        start_server()
+        before = history_size()
+        renders = 30
+        for i in range(renders):
+            # A new connection per render so the kernel spreads them over workers
+            render('{"n": 1}', f'{{{{ data.n + {i} }}}}').read()
+        sizes = {history_size() for _ in range(WORKERS * 3)}
+        if sizes == {before + renders}:
+            print(f"  ✅ All {renders} renders recorded, every worker reports {before + renders}")
+            return True
+        print(f"  ❌ Expected history size {before + renders}, workers report {sizes}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing history: {e}")
+        return False
+
+def test_shared_results():
+    """Test that truncated results can be fetched from any worker."""
+    print("\nTesting truncated results across workers...")
+
+    try:
+        start_server()
+        response = render('{}', '{% for i in range(500) %}{{ i }},{% endfor %}')
+        response.read()
+        result_id = response.headers.get('X-Result-Id')
+        if not result_id:
+            print("  ❌ Output was not truncated")
+            return False
+        for _ in range(WORKERS * 3):
+            url = SERVER_URL + '/result?' + urllib.parse.urlencode({'id': result_id, 'offset': 1000})
+            urllib.request.urlopen(url).read()
+        print("  ✅ Result chunks served by every request")
+        return True
+    except urllib.error.HTTPError as e:
+        print(f"  ❌ Result fetch failed with {e.code}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing results: {e}")
+        return False
+
+def test_worker_restart():
+    """Test that the supervisor replaces a worker that dies."""
+    print("\nTesting worker restart...")
+
+    try:
+        start_server()
+        victim = worker_pids()[0]
+        os.kill(victim, signal.SIGKILL)
+        for _ in range(50):
+            pids = worker_pids()
+            if victim not in pids and len(pids) == WORKERS:
+                break
+            time.sleep(0.1)
+        pids = worker_pids()
+        if victim not in pids and len(pids) == WORKERS:
+            render('{"a": 1}', '{{ data.a }}').read()
+            print(f"  ✅ Worker {victim} replaced, {WORKERS} workers running")
+            return True
+        print(f"  ❌ Worker not replaced: {pids}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing restart: {e}")
+        return False
+
+def run_all_tests():
+    """Run all pre-fork mode tests."""
+    print("=" * 60)
+    print("PRE-FORK SERVER MODE TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Workers Started", test_workers_started),
+        ("Single History Writer", test_single_history_writer),
+        ("Shared Results", test_shared_results),
+        ("Worker Restart", test_worker_restart)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    stop_server()
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Test for the render execution budget.
+Checks the X-Render-Budget usage header, that loop passes, lookups and calls
+are counted, that a runaway template is stopped with a clear error on
+both /render and the live-render WebSocket, and that /settings refuses
+limits the server could not start with.
+"""
+
+import json
+import os
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+from websocket_render_test import WebSocketClient
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+RUNAWAY = "{% for i in range(100000) %}{% for j in range(100000) %}{% endfor %}{% endfor %}"
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    return urllib.request.urlopen(req)
+
+def test_budget_header():
+    """Test that a render reports the operations it used and the limits."""
+    print("Testing X-Render-Budget header...")
+
+    try:
+        # A fresh input so the render cache cannot answer
+        data = json.dumps({'run': time.time_ns(), 'hosts': [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]})
+        small = json.loads(render(data, '{{ data.hosts[0].name }}').headers.get('X-Render-Budget'))
+        large = json.loads(render(data, '{% for h in data.hosts %}{{ h.name }}{% endfor %}').headers.get('X-Render-Budget'))
+        if small['operations'] >= 3 and large['operations'] > small['operations'] and \
+                small['max_operations'] > 0 and 'ms' in small and 'max_ms' in small:
+            print(f"  ✅ Operations counted: {small['operations']} for a lookup, {large['operations']} for a loop")
+            return True
+        print(f"  ❌ Unexpected usage: {small}, {large}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error reading budget header: {e}")
+        return False
+
+def test_runaway_render_stopped():
+    """Test that a template exceeding the budget is aborted with a clear error."""
+    print("\nTesting runaway render on /render...")
+
+    try:
+        start = time.perf_counter()
+        render('{}', RUNAWAY)
+        print("  ❌ Runaway render completed")
+        return False
+    except urllib.error.HTTPError as e:
+        elapsed = time.perf_counter() - start
+        message = e.read().decode('utf-8')
+        usage = json.loads(e.headers.get('X-Render-Budget', '{}'))
+        if e.code == 400 and message.startswith('Render budget exceeded') and usage.get('operations', 0) > 0:
+            print(f"  ✅ Stopped after {elapsed:.1f}s: {message}")
+            return True
+        print(f"  ❌ Unexpected response: {e.code} {message} {usage}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing runaway render: {e}")
+        return False
+
+def test_runaway_websocket_render():
+    """Test that the live-render channel reports budget errors as error frames."""
+    print("\nTesting runaway render on /ws/render...")
+
+    try:
+        client = WebSocketClient()
+        client.send({'seq': 1, 'json': '{}', 'expr': RUNAWAY})
+        reply = client.receive()
+        client.close()
+        if reply.get('seq') == 1 and not reply.get('ok') and \
+                reply.get('error', '').startswith('Render budget exceeded') and \
+                'X-Render-Budget' in reply.get('headers', {}):
+            print(f"  ✅ Error frame: {reply['error']}")
+            return True
+        print(f"  ❌ Unexpected reply: {reply}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing WebSocket render: {e}")
+        return False
+
+def test_invalid_settings_rejected():
+    """Test that values the server parses at startup are checked before they are saved."""
+    print("\nTesting invalid startup settings posted to /settings...")
+
+    changes = [
+        {'section': 'render_budget', 'max_seconds': 'thirty'},
+        {'section': 'render_budget', 'memory_tracking': 'psutil'},
+        {'section': 'server', 'keep_alive_timeout': '0'},
+        {'section': 'render_cache', 'max_bytes': '64MB'},
+        {'section': 'output', 'chunk_size': '-1'},
+        {'section': 'input', 'lazy_json': 'maybe'},
+        {'section': 'filter_cache', 'max_entries': '1.5'},
+        {'section': 'input_cache', 'max_bytes': 'lots'},
+    ]
+    all_ok = True
+    try:
+        conf_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jinja2_eval_web.conf')
+        with open(conf_path, 'r', encoding='utf-8') as f:
+            before = f.read()
+        for change in changes:
+            data = urllib.parse.urlencode(change).encode('utf-8')
+            try:
+                urllib.request.urlopen(urllib.request.Request(SERVER_URL + '/settings', data=data)).read()
+                status, error = 200, ''
+            except urllib.error.HTTPError as e:
+                status, error = e.code, json.loads(e.read().decode('utf-8')).get('error', '')
+            key = [k for k in change if k != 'section'][0]
+            if status == 400 and key in error:
+                print(f"  ✅ [{change['section']}] {key} = {change[key]!r}: {error}")
+            else:
+                print(f"  ❌ [{change['section']}] {key} = {change[key]!r}: {status} {error}")
+                all_ok = False
+        with open(conf_path, 'r', encoding='utf-8') as f:
+            if f.read() != before:
+                print("  ❌ Configuration file changed")
+                all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing invalid settings: {e}")
+        return False
+
+def run_all_tests():
+    """Run all render budget tests."""
+    print("=" * 60)
+    print("RENDER BUDGET TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Budget Header", test_budget_header),
+        ("Runaway Render Stopped", test_runaway_render_stopped),
+        ("Runaway WebSocket Render", test_runaway_websocket_render),
+        ("Invalid Settings Rejected", test_invalid_settings_rejected)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
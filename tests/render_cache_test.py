@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Test for the render result cache.
+Verifies repeated renders are served from the cache, non-deterministic
+templates bypass it, and the X-Render-Cache header reports the outcome.
+"""
+
+import urllib.request
+import urllib.error
+import urllib.parse
+import time
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+
+def render(json_text, expr):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    response = urllib.request.urlopen(req)
+    return response.read().decode('utf-8'), response.headers
+
+def test_repeated_render_hits_cache():
+    """Test that the same (input, template) pair is served from the cache."""
+    print("Testing repeated render...")
+
+    try:
+        # Unique input so earlier runs do not pre-populate the cache
+        json_text = f'{{"stamp": {time.time()}, "items": [3, 1, 2]}}'
+        expr = '{{ data["items"] | sort | to_json }}'
+        first, first_headers = render(json_text, expr)
+        second, second_headers = render(json_text, expr)
+
+        if first_headers.get('X-Render-Cache') != 'miss':
+            print(f"  ❌ First render expected miss, got {first_headers.get('X-Render-Cache')}")
+            return False
+        if second_headers.get('X-Render-Cache') != 'hit':
+            print(f"  ❌ Second render expected hit, got {second_headers.get('X-Render-Cache')}")
+            return False
+        if first != second or second_headers.get('X-Result-Type') != 'json' or \
+                second_headers.get('X-Input-Format') != 'JSON':
+            print("  ❌ Cached result or metadata differs from the original render")
+            return False
+        print("  ✅ Miss then hit with identical output and metadata")
+        return True
+    except Exception as e:
+        print(f"  ❌ Error testing render cache: {e}")
+        return False
+
+def test_nondeterministic_bypass():
+    """Test that templates using random/shuffle/now never hit the cache."""
+    print("\nTesting non-deterministic templates...")
+
+    templates = [
+        '{{ data | random }}',
+        '{{ data | shuffle | to_json }}',
+        '{% if data is defined %}{{ lipsum(1) }}{% endif %}',
+        '{{ now() if now is defined else "" }}',
+    ]
+
+    all_ok = True
+    for expr in templates:
+        try:
+            render('[1, 2, 3]', expr)
+            _, headers = render('[1, 2, 3]', expr)
+            status = headers.get('X-Render-Cache')
+            if status == 'bypass':
+                print(f"  ✅ {expr}: bypass")
+            else:
+                print(f"  ❌ {expr}: expected bypass, got {status}")
+                all_ok = False
+        except urllib.error.HTTPError as e:
+            print(f"  ❌ {expr}: render failed with {e.code}")
+            all_ok = False
+    return all_ok
+
+def test_errors_not_cached():
+    """Test that failed renders are reported again instead of being cached."""
+    print("\nTesting error responses...")
+
+    for _ in range(2):
+        try:
+            render('{}', '{{ data.missing }}')
+            print("  ❌ Expected 400 for undefined attribute")
+            return False
+        except urllib.error.HTTPError as e:
+            if e.code != 400 or e.headers.get('X-Render-Cache'):
+                print(f"  ❌ Unexpected error response: {e.code} {e.headers.get('X-Render-Cache')}")
+                return False
+    print("  ✅ Errors are not cached")
+    return True
+
+def run_all_tests():
+    """Run all render cache tests."""
+    print("=" * 60)
+    print("RENDER CACHE TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Repeated Render Hits Cache", test_repeated_render_hits_cache),
+        ("Non-deterministic Bypass", test_nondeterministic_bypass),
+        ("Errors Not Cached", test_errors_not_cached)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
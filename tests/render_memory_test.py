@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Test for per-render peak memory accounting.
+Checks the X-Render-Peak-Memory header, that measurements are stored with
+history entries, that /history/stats aggregates them per expression and
+that overlapping renders are not measured. Starts a copy of the server with
+a low memory limit on a spare port and checks a render making few but large
+allocations is stopped while it runs.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+PORT = 8768
+LIMITED_SERVER_URL = f"http://localhost:{PORT}"
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# About 60 operations, each allocating 100000 strings
+HEAVY = ("{% set ns = namespace(a=[]) %}{% for i in range(60) %}"
+         "{% set _ = ns.a.append(range(100000) | map('string') | list) %}{% endfor %}{{ ns.a | length }}")
+
+server = None
+
+def start_server():
+    """Copy the application to a temporary directory and run it with a 64 MB render limit."""
+    global server
+    if server is not None:
+        return server
+    work_dir = tempfile.mkdtemp(prefix='render_memory_test_')
+    with open(os.path.join(ROOT_DIR, 'jinja2_eval_web.py'), 'r', encoding='utf-8') as f:
+        source = f.read().replace('PORT = 8000', f'PORT = {PORT}', 1)
+    with open(os.path.join(work_dir, 'jinja2_eval_web.py'), 'w', encoding='utf-8') as f:
+        f.write(source)
+    shutil.copy(os.path.join(ROOT_DIR, 'jinja2_eval_web.html'), work_dir)
+    shutil.copytree(os.path.join(ROOT_DIR, 'jinja2_eval_web_static'), os.path.join(work_dir, 'jinja2_eval_web_static'))
+    with open(os.path.join(work_dir, 'jinja2_eval_web.conf'), 'w', encoding='utf-8') as f:
+        f.write("[render_budget]\nmax_memory_mb = 64\n")
+
+    process = subprocess.Popen([sys.executable, 'jinja2_eval_web.py'], cwd=work_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = (process, work_dir)
+    atexit.register(stop_server)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(LIMITED_SERVER_URL + '/history/size')
+            break
+        except Exception:
+            time.sleep(0.1)
+    return server
+
+def stop_server():
+    global server
+    if server is None:
+        return
+    process, work_dir = server
+    process.terminate()
+    process.wait(timeout=10)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    server = None
+
+def render(json_text, expr, base=SERVER_URL):
+    data = urllib.parse.urlencode({'json': json_text, 'expr': expr}).encode('utf-8')
+    req = urllib.request.Request(base + '/render', data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    return urllib.request.urlopen(req)
+
+def get_json(path):
+    return json.loads(urllib.request.urlopen(SERVER_URL + path).read().decode('utf-8'))
+
+def test_peak_memory_header():
+    """Test that rendered results carry their peak memory and cache hits do not."""
+    print("Testing X-Render-Peak-Memory header...")
+
+    try:
+        expr = f"{{% set x = range(50000) | list %}}{{{{ x | length }}}} {time.time_ns()}"
+        first = render('{}', expr)
+        first.read()
+        second = render('{}', expr)
+        second.read()
+        peak = first.headers.get('X-Render-Peak-Memory')
+        if peak is not None and int(peak) >= 0 and second.headers.get('X-Render-Cache') == 'hit' \
+                and second.headers.get('X-Render-Peak-Memory') is None:
+            print(f"  ✅ Peak memory {int(peak):,} bytes; cache hit has no measurement")
+            return True
+        print(f"  ❌ Unexpected headers: {peak}, hit: {second.headers.get('X-Render-Peak-Memory')}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing peak memory header: {e}")
+        return False
+
+def test_history_stats():
+    """Test that /history/stats groups measured renders by expression, heaviest first."""
+    print("\nTesting /history/stats...")
+
+    try:
+        expr = f"{{{{ data.n }}}} {time.time_ns()}"
+        for n in range(3):
+            render(json.dumps({'n': n}), expr).read()
+        history = get_json('/history')
+        stats = get_json('/history/stats')
+
+        all_ok = True
+        measured = [e for e in history if e.get('expr') == expr]
+        if len(measured) == 3 and all('peak_memory' in e for e in measured):
+            print("  ✅ History entries store the peak memory")
+        else:
+            print(f"  ❌ Unexpected history entries: {measured}")
+            all_ok = False
+
+        entry = next((s for s in stats if s['expr'] == expr), None)
+        peaks = [s['max_peak_memory'] for s in stats]
+        if entry and entry['renders'] == 3 and entry['avg_peak_memory'] <= entry['max_peak_memory'] \
+                and peaks == sorted(peaks, reverse=True):
+            print(f"  ✅ {len(stats)} expressions, sorted by peak; this one rendered {entry['renders']} times")
+        else:
+            print(f"  ❌ Unexpected stats entry: {entry}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing history stats: {e}")
+        return False
+
+def test_overlapping_renders_not_measured():
+    """Test that a render overlapping another one reports no peak memory."""
+    print("\nTesting overlapping renders...")
+
+    try:
+        heavy = HEAVY.replace('range(60)', 'range(10)') + f' {time.time_ns()}'
+        results = {}
+
+        def run():
+            response = render('{}', heavy)
+            response.read()
+            results['heavy'] = response.headers.get('X-Render-Peak-Memory')
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.3)
+        light = render('{}', f'{{{{ 1 }}}} {time.time_ns()}')
+        light.read()
+        thread.join()
+        alone = render('{}', f'{{{{ 2 }}}} {time.time_ns()}')
+        alone.read()
+        if light.headers.get('X-Render-Peak-Memory') is None and results['heavy'] is None \
+                and alone.headers.get('X-Render-Peak-Memory') is not None:
+            print("  ✅ Overlapping renders unmeasured, a render alone measured")
+            return True
+        print(f"  ❌ Unexpected peaks: light {light.headers.get('X-Render-Peak-Memory')}, "
+              f"heavy {results['heavy']}, alone {alone.headers.get('X-Render-Peak-Memory')}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing overlapping renders: {e}")
+        return False
+
+def test_limit_enforced_during_render():
+    """Test that a render with few, large allocations is stopped while it runs."""
+    print("\nTesting the memory limit on a render with few operations...")
+
+    try:
+        start_server()
+        started = time.monotonic()
+        try:
+            render('{}', HEAVY + f' {time.time_ns()}', base=LIMITED_SERVER_URL).read()
+            status, message = 200, ''
+        except urllib.error.HTTPError as e:
+            status, message = e.code, e.read().decode('utf-8')
+        elapsed = time.monotonic() - started
+        # The whole render takes several seconds and some 400 MB; it must stop
+        # soon after passing 64 MB, not when it ends
+        if status == 400 and 'Render memory limit exceeded' in message and elapsed < 5:
+            print(f"  ✅ Stopped after {elapsed:.1f}s: {message}")
+            return True
+        print(f"  ❌ Unexpected result after {elapsed:.1f}s: {status} {message[:200]}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing memory limit: {e}")
+        return False
+
+def run_all_tests():
+    """Run all render memory tests."""
+    print("=" * 60)
+    print("RENDER MEMORY TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Peak Memory Header", test_peak_memory_header),
+        ("History Stats", test_history_stats),
+        ("Overlapping Renders Not Measured", test_overlapping_renders_not_measured),
+        ("Limit Enforced During Render", test_limit_enforced_during_render)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    stop_server()
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
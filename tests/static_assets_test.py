@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Test for locally served frontend assets.
+Verifies the page references no external hosts and that every bundled
+asset, including the format-detection worker, is served with a
+content-hashed URL, immutable caching and gzip.
+"""
+
+import urllib.request
+import urllib.error
+import re
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+
+def get_page():
+    response = urllib.request.urlopen(SERVER_URL)
+    return response.read().decode('utf-8')
+
+def test_no_external_assets():
+    """Test that the HTML page does not load anything from public CDNs."""
+    print("Testing HTML page for external asset references...")
+
+    try:
+        html_content = get_page()
+        external = re.findall(r'(?:src|href)="(https?://[^"]+)"', html_content)
+        if external:
+            for url in external:
+                print(f"  ❌ External asset referenced: {url}")
+            return False
+        print("  ✅ No external assets referenced")
+        return True
+    except Exception as e:
+        print(f"  ❌ Error loading page: {e}")
+        return False
+
+def test_hashed_assets_cached():
+    """Test that every /static/ reference is hashed, immutable and gzip-capable."""
+    print("\nTesting hashed static assets...")
+
+    try:
+        html_content = get_page()
+        urls = re.findall(r'(?:src|href)="(/static/[^"]+)"', html_content)
+        if len(urls) < 12:
+            print(f"  ❌ Expected at least 12 static assets, found {len(urls)}")
+            return False
+
+        all_ok = True
+        for url in urls:
+            if not re.search(r'\.[0-9a-f]{12}\.(js|css)$', url):
+                print(f"  ❌ Asset URL is not content-hashed: {url}")
+                all_ok = False
+                continue
+
+            req = urllib.request.Request(SERVER_URL + url, headers={'Accept-Encoding': 'gzip'})
+            response = urllib.request.urlopen(req)
+            response.read()
+            cache_control = response.headers.get('Cache-Control', '')
+            encoding = response.headers.get('Content-Encoding', '')
+
+            if 'immutable' not in cache_control:
+                print(f"  ❌ {url}: missing immutable caching ({cache_control})")
+                all_ok = False
+            elif encoding != 'gzip':
+                print(f"  ❌ {url}: gzip variant not served")
+                all_ok = False
+            else:
+                print(f"  ✅ {url}: immutable, gzip")
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing static assets: {e}")
+        return False
+
+def test_worker_script_hashed():
+    """Test that the format-detection worker is started from its hashed URL."""
+    print("\nTesting format-detection worker URL...")
+
+    try:
+        html_content = get_page()
+        match = re.search(r'new Worker\("(/static/format-detect\.[0-9a-f]{12}\.js)"\)', html_content)
+        if not match:
+            print("  ❌ Worker URL is not content-hashed")
+            return False
+        script = urllib.request.urlopen(SERVER_URL + match.group(1)).read().decode('utf-8')
+        if 'function detectFormat' in script and 'onmessage' in script:
+            print(f"  ✅ {match.group(1)}")
+            return True
+        print(f"  ❌ Unexpected worker script: {script[:80]!r}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing worker script: {e}")
+        return False
+
+def test_unknown_asset():
+    """Test that unknown and traversal paths under /static/ return 404."""
+    print("\nTesting unknown static paths...")
+
+    all_ok = True
+    for path in ['/static/missing.js', '/static/../jinja2_eval_web.py']:
+        try:
+            urllib.request.urlopen(SERVER_URL + path)
+            print(f"  ❌ {path}: expected 404")
+            all_ok = False
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                print(f"  ✅ {path}: 404")
+            else:
+                print(f"  ❌ {path}: expected 404, got {e.code}")
+                all_ok = False
+    return all_ok
+
+def run_all_tests():
+    """Run all static asset tests."""
+    print("=" * 60)
+    print("STATIC ASSETS TEST")
+    print("=" * 60)
+
+    tests = [
+        ("No External Assets", test_no_external_assets),
+        ("Hashed Assets Cached", test_hashed_assets_cached),
+        ("Worker Script Hashed", test_worker_script_hashed),
+        ("Unknown Asset", test_unknown_asset)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Test for the saved template library.
+Saves templates through the API, renders them by name, includes and
+imports them from editor templates and checks name validation.
+"""
+
+import json
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Test configuration
+SERVER_URL = "http://localhost:8000"
+PREFIX = "_library_test"
+
+INPUT_JSON = json.dumps({"hosts": [{"name": "web1", "port": 80}, {"name": "db1", "port": 5432}]})
+
+def post(path, fields):
+    data = urllib.parse.urlencode(fields).encode('utf-8')
+    req = urllib.request.Request(SERVER_URL + path, data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+    response = urllib.request.urlopen(req)
+    return response.read().decode('utf-8'), response.headers
+
+def save(name, source):
+    return post('/templates/save', {'name': f'{PREFIX}/{name}', 'source': source})
+
+def test_save_and_list():
+    """Test saving templates and listing them."""
+    print("Testing save and list...")
+
+    try:
+        save('macros.j2', '{% macro hostport(h) %}{{ h.name }}:{{ h.port }}{% endmacro %}')
+        save('page.j2', '{% import "' + PREFIX + '/macros.j2" as m %}{% for h in data.hosts %}{{ m.hostport(h) }} {% endfor %}')
+        names = json.loads(urllib.request.urlopen(SERVER_URL + '/templates').read().decode('utf-8'))
+        source = urllib.request.urlopen(
+            SERVER_URL + '/template-content?' + urllib.parse.urlencode({'name': f'{PREFIX}/macros.j2'})).read().decode('utf-8')
+        if f'{PREFIX}/macros.j2' in names and f'{PREFIX}/page.j2' in names and 'macro hostport' in source:
+            print("  ✅ Templates saved, listed and readable")
+            return True
+        print(f"  ❌ Unexpected listing {names} or source {source!r}")
+        return False
+    except urllib.error.HTTPError as e:
+        print(f"  ❌ Request failed with {e.code}: {e.read().decode()}")
+        return False
+
+def test_render_by_name_and_include():
+    """Test render-by-name, import from the editor and include with the input."""
+    print("\nTesting render by name, import and include...")
+
+    cases = [
+        ({'name': f'{PREFIX}/page.j2'}, 'web1:80 db1:5432 '),
+        ({'expr': '{% from "' + PREFIX + '/macros.j2" import hostport %}{{ hostport(data.hosts[1]) }}'}, 'db1:5432'),
+        # The included template reads data.hosts even though the editor template does not
+        ({'expr': '[{% include "' + PREFIX + '/page.j2" %}]'}, '[web1:80 db1:5432 ]'),
+    ]
+    all_ok = True
+    for fields, expected in cases:
+        try:
+            output, headers = post('/render', dict(fields, json=INPUT_JSON))
+            if output == expected and headers.get('X-Render-Cache') == 'bypass':
+                print(f"  ✅ {fields}: {output!r}")
+            else:
+                print(f"  ❌ {fields}: got {output!r} ({headers.get('X-Render-Cache')}), expected {expected!r}")
+                all_ok = False
+        except urllib.error.HTTPError as e:
+            print(f"  ❌ {fields}: render failed with {e.code}: {e.read().decode()}")
+            all_ok = False
+
+    try:
+        # Changing a saved macro must show up in the next render
+        save('macros.j2', '{% macro hostport(h) %}{{ h.name }}@{{ h.port }}{% endmacro %}')
+        output, _ = post('/render', {'name': f'{PREFIX}/page.j2', 'json': INPUT_JSON})
+        if output == 'web1@80 db1@5432 ':
+            print("  ✅ Updated macro picked up")
+        else:
+            print(f"  ❌ Stale output after update: {output!r}")
+            all_ok = False
+    except urllib.error.HTTPError as e:
+        print(f"  ❌ Update failed with {e.code}: {e.read().decode()}")
+        all_ok = False
+    return all_ok
+
+def test_invalid_requests():
+    """Test name validation, syntax errors, names taken by directories or files and missing templates."""
+    print("\nTesting invalid requests...")
+
+    cases = [
+        ('/templates/save', {'name': '../escape.j2', 'source': 'x'}, 403),
+        ('/templates/save', {'name': f'{PREFIX}/.hidden', 'source': 'x'}, 403),
+        ('/templates/save', {'name': f'{PREFIX}/broken.j2', 'source': '{{ oops'}, 400),
+        ('/templates/save', {'name': PREFIX, 'source': 'x'}, 409),
+        ('/templates/save', {'name': f'{PREFIX}/macros.j2/x', 'source': 'x'}, 409),
+        ('/render', {'name': f'{PREFIX}/missing.j2', 'json': '{}'}, 404),
+        ('/templates/delete', {'name': f'{PREFIX}/missing.j2'}, 404),
+    ]
+    all_ok = True
+    for path, fields, status in cases:
+        try:
+            post(path, fields)
+            print(f"  ❌ {path} {fields['name']}: expected {status}, got 200")
+            all_ok = False
+        except urllib.error.HTTPError as e:
+            e.read()
+            if e.code == status:
+                print(f"  ✅ {path} {fields['name']}: {status}")
+            else:
+                print(f"  ❌ {path} {fields['name']}: expected {status}, got {e.code}")
+                all_ok = False
+    names = json.loads(urllib.request.urlopen(SERVER_URL + '/templates').read().decode('utf-8'))
+    if any(name.endswith('.tmp') for name in names):
+        print(f"  ❌ Failed saves left temporary files: {names}")
+        all_ok = False
+    return all_ok
+
+def test_delete():
+    """Test deleting the saved test templates."""
+    print("\nTesting delete...")
+
+    try:
+        for name in ('page.j2', 'macros.j2'):
+            post('/templates/delete', {'name': f'{PREFIX}/{name}'})
+        names = json.loads(urllib.request.urlopen(SERVER_URL + '/templates').read().decode('utf-8'))
+        if not any(name.startswith(PREFIX + '/') for name in names):
+            print("  ✅ Templates deleted")
+            return True
+        print(f"  ❌ Templates still listed: {names}")
+        return False
+    except urllib.error.HTTPError as e:
+        print(f"  ❌ Delete failed with {e.code}: {e.read().decode()}")
+        return False
+
+def run_all_tests():
+    """Run all template library tests."""
+    print("=" * 60)
+    print("TEMPLATE LIBRARY TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Save And List", test_save_and_list),
+        ("Render By Name And Include", test_render_by_name_and_include),
+        ("Invalid Requests", test_invalid_requests),
+        ("Delete", test_delete)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Test for the /ws/render live-render WebSocket channel.
+Uses a minimal stdlib WebSocket client to check the handshake, sequence
+tagging, partial updates against the session state, that templates
+modifying their input do not change it for later renders, error frames, the
+Origin check and the refusal of oversized and unmasked frames.
+"""
+
+import base64
+import json
+import os
+import socket
+import struct
+import time
+import urllib.request
+import urllib.parse
+
+# Test configuration
+HOST = "localhost"
+PORT = 8000
+
+class WebSocketClient:
+    """Just enough of RFC 6455 to talk to the render endpoint."""
+
+    def __init__(self, path='/ws/render', origin=None):
+        self.sock = socket.create_connection((HOST, PORT), timeout=10)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {HOST}:{PORT}\r\n"
+            + (f"Origin: {origin}\r\n" if origin else "") +
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        )
+        self.sock.sendall(request.encode('ascii'))
+        self.rfile = self.sock.makefile('rb')
+        self.status_line = self.rfile.readline().decode('ascii').strip()
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+
+    def send(self, message):
+        payload = json.dumps(message).encode('utf-8')
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x81, 0x80 | 127, length)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def receive(self):
+        first, second = self.rfile.read(2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def receive_close_code(self):
+        first, second = self.rfile.read(2)
+        payload = self.rfile.read(second & 0x7F)
+        return first & 0x0F, struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else None
+
+    def close(self):
+        try:
+            self.sock.sendall(struct.pack('!BB', 0x88, 0x80) + os.urandom(4))
+        finally:
+            self.sock.close()
+
+def test_handshake():
+    """Test that the endpoint upgrades the connection."""
+    print("Testing WebSocket handshake...")
+
+    try:
+        client = WebSocketClient()
+        client.close()
+        if client.status_line.startswith('HTTP/1.1 101'):
+            print("  ✅ Connection upgraded (101)")
+            return True
+        print(f"  ❌ Unexpected status line: {client.status_line}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error during handshake: {e}")
+        return False
+
+def test_render_session():
+    """Test full and partial renders with sequence numbers and metadata."""
+    print("\nTesting render session messages...")
+
+    try:
+        client = WebSocketClient()
+        client.send({'seq': 1, 'json': '{"name": "Test", "items": [1, 2]}', 'expr': '{{ data.name }}'})
+        first = client.receive()
+
+        # Only the template changes; the session must reuse the parsed input
+        client.send({'seq': 2, 'expr': '{{ data["items"] | to_json }}'})
+        second = client.receive()
+
+        # Only the input changes, as YAML; the template must be reused
+        client.send({'seq': 3, 'json': 'items:\n  - 3\n  - 4'})
+        third = client.receive()
+        client.close()
+
+        all_ok = True
+        checks = [
+            (first, 1, 'Test', 'string', 'JSON'),
+            (second, 2, '[\n  1,\n  2\n]', 'json', 'JSON'),
+            (third, 3, '[\n  3,\n  4\n]', 'json', 'YAML'),
+        ]
+        for reply, seq, output, result_type, input_format in checks:
+            headers = reply.get('headers', {})
+            if (reply.get('seq') == seq and reply.get('ok') and reply.get('output') == output
+                    and headers.get('X-Result-Type') == result_type
+                    and headers.get('X-Input-Format') == input_format):
+                print(f"  ✅ seq {seq}: {result_type} result from {input_format} input")
+            else:
+                print(f"  ❌ seq {seq}: unexpected reply {reply}")
+                all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing render session: {e}")
+        return False
+
+def test_mutating_template():
+    """Test that a template appending to its input renders the same every time, as on /render."""
+    print("\nTesting templates that modify their input...")
+
+    try:
+        # A fresh input so the render cache cannot answer
+        json_text = json.dumps({'run': time.time_ns(), 'l': [1]})
+        expr = '{% set _ = data.l.append(2) %}{{ data.l | join(",") }}'
+        client = WebSocketClient()
+        client.send({'seq': 1, 'json': json_text, 'expr': expr})
+        first = client.receive()
+        # A whitespace edit renders the template again against the session data
+        client.send({'seq': 2, 'expr': expr + ' '})
+        second = client.receive()
+        client.close()
+        data = urllib.parse.urlencode({'json': json_text, 'expr': expr + '  '}).encode('utf-8')
+        expected = urllib.request.urlopen(urllib.request.Request(f'http://{HOST}:{PORT}/render', data=data)).read().decode('utf-8')
+
+        if first.get('output') == '1,2' and second.get('output') == '1,2 ' and expected == '1,2  ':
+            print("  ✅ Each render starts from the input as written")
+            return True
+        print(f"  ❌ Unexpected outputs: {first.get('output')!r}, {second.get('output')!r}, /render {expected!r}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error testing mutating template: {e}")
+        return False
+
+def test_error_frames():
+    """Test that input and template errors come back as tagged error frames."""
+    print("\nTesting error frames...")
+
+    try:
+        client = WebSocketClient()
+        client.send({'seq': 7, 'json': '{}', 'expr': '{{ broken'})
+        template_error = client.receive()
+        client.send({'seq': 8, 'json': '{"a": [1, 2', 'expr': '{{ data }}'})
+        input_error = client.receive()
+        client.close()
+
+        all_ok = True
+        if template_error.get('seq') == 7 and not template_error.get('ok') and \
+                template_error.get('error', '').startswith('Jinja expression error'):
+            print("  ✅ Template error reported")
+        else:
+            print(f"  ❌ Unexpected template error reply: {template_error}")
+            all_ok = False
+        if input_error.get('seq') == 8 and not input_error.get('ok') and \
+                input_error.get('error', '').startswith('Input parsing error'):
+            print("  ✅ Input error reported")
+        else:
+            print(f"  ❌ Unexpected input error reply: {input_error}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing error frames: {e}")
+        return False
+
+def test_refused_origins_and_frames():
+    """Test that foreign origins, oversized and unmasked frames are refused."""
+    print("\nTesting origin check and frame limits...")
+
+    try:
+        all_ok = True
+        foreign = WebSocketClient(origin='http://evil.example')
+        foreign.sock.close()
+        own = WebSocketClient(origin=f'http://{HOST}:{PORT}')
+        own.close()
+        if foreign.status_line.startswith('HTTP/1.1 403') and own.status_line.startswith('HTTP/1.1 101'):
+            print("  ✅ Foreign origin refused (403), own origin upgraded")
+        else:
+            print(f"  ❌ Unexpected status lines: {foreign.status_line}, {own.status_line}")
+            all_ok = False
+
+        # A text frame declaring 2^36 bytes, without sending them
+        client = WebSocketClient()
+        client.sock.sendall(struct.pack('!BBQ', 0x81, 0x80 | 127, 1 << 36) + os.urandom(4))
+        too_big = client.receive_close_code()
+        client.sock.close()
+        client = WebSocketClient()
+        client.sock.sendall(struct.pack('!BB', 0x81, 2) + b'{}')
+        unmasked = client.receive_close_code()
+        client.sock.close()
+        if too_big == (0x8, 1009) and unmasked == (0x8, 1002):
+            print("  ✅ Oversized message closed with 1009, unmasked frame with 1002")
+        else:
+            print(f"  ❌ Unexpected close frames: {too_big}, {unmasked}")
+            all_ok = False
+        return all_ok
+    except Exception as e:
+        print(f"  ❌ Error testing origin and frame limits: {e}")
+        return False
+
+def run_all_tests():
+    """Run all WebSocket render tests."""
+    print("=" * 60)
+    print("WEBSOCKET LIVE-RENDER TEST")
+    print("=" * 60)
+
+    tests = [
+        ("Handshake", test_handshake),
+        ("Render Session", test_render_session),
+        ("Mutating Template", test_mutating_template),
+        ("Error Frames", test_error_frames),
+        ("Refused Origins And Frames", test_refused_origins_and_frames)
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        print(f"\n🧪 Running: {test_name}")
+        result = test_func()
+        results.append((test_name, result))
+        print(f"{'✅' if result else '❌'} {test_name}: {'PASSED' if result else 'FAILED'}")
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTests passed: {passed}/{len(results)}")
+    return passed == len(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)